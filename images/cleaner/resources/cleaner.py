@@ -20,145 +20,337 @@ import logging
 import sys
 import time
 import requests
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
 from os import environ
-from os.path import basename, expanduser, isfile
 from subprocess import Popen, PIPE
 from ochopod.core.fsm import diagnostic
 from ochopod.core.utils import retry, shell
+from discovery import Supervisor, Worker, expand
+from events import ZooKeeper
+from metrics import REGISTRY
+from portal import Portal
+from scheduler import Rest, Scheduler, advance
+from snapshot import Snapshot
+from tracing import TRACER, install, phase
 from pykka import ThreadingActor, ThreadingFuture, Timeout, ActorRegistry
 from pykka.exceptions import ActorDeadError
 
 logger = logging.getLogger('ochopod')
 
-class Cleaner(ThreadingActor):
+_requests = REGISTRY.counter('cleaner_requests_total', 'Kill & reset requests completed, by command and outcome.', ['command', 'outcome'])
 
-    def __init__(self, remote, cluster, period=60.0, wait=10.0):
+class Cleaner(Worker):
+    """
+        Cleaning engine for all the dirty clusters: every period one pass greps all of them at once, waits and greps
+        again, then kills the pods still dead & resets the ones still stopped. Those kill/reset requests are fanned out
+        over a bounded pool of threads, at most one kill & one reset per cluster being in flight and successive kills
+        (or resets) against a cluster being spaced by at least interval seconds. Completed requests are reported back to the actor along with
+        their latency.
+
+        :param remote: function used to pass toolset commands to the portal
+        :param scheduler: the Scheduler waking the actor up
+        :param clusters: list of cluster glob patterns
+        :param period: float number of seconds between passes
+        :param wait: float number of seconds a pod must stay dead/stopped before being cleaned
+        :param size: int number of kill/reset requests in flight at most
+        :param interval: float minimum number of seconds between two kills (or resets) against the same cluster
+    """
+
+    def __init__(self, remote, scheduler, clusters, period=60.0, wait=10.0, size=8, interval=30.0):
 
-            super(Cleaner, self).__init__() 
+            super(Cleaner, self).__init__(scheduler, clusters) 
 
             self.remote = remote
-            self.cluster = cluster
             self.period = period
             self.wait = wait
+            self.size = size
+            self.interval = interval
+            self.pool = None
+            self.task = None
+
+            #
+            # - (cluster, command) pairs with a request in flight, (cluster, command) -> time of the last request
+            #
+            self.inflight = set()
+            self.last = {}
 
     def on_start(self):
 
-        logger.info('Starting Cleaner for %s...' % self.cluster)
-        self.actor_ref.tell({'action': 'clean'})
+        logger.info('Starting Cleaner for %s...' % ', '.join(self.clusters))
+        self.pool = ThreadPool(self.size)
+        super(Cleaner, self).on_start()
 
     def on_receive(self, msg):
 
-        if 'action' in msg and msg['action'] == 'clean':
+        if msg.get('action') == 'done':
 
             try:
 
-                _clean(remote=self.remote, 
-                        cluster=self.cluster, 
-                        period=self.period,
-                        wait=self.wait) 
+                self._done(msg)
 
             except Exception as e:
 
-                logger.warning('Cleaner actor for %s exception: %s' % (self.cluster, e))
-            
-            self.actor_ref.tell({'action': 'clean'})
+                logger.warning('Cleaner actor exception: %s' % e)
+
+        else:
+
+            super(Cleaner, self).on_receive(msg)
+
+    def chain(self, cluster):
+
+        #
+        # - all the clusters are cleaned in one pass, clusters coming & going applying from the next pass on
+        #
+        return 'clusters'
+
+    def tick(self, chain):
+
+        #
+        # - run the pass up to its next pause and have the scheduler wake us up once it is over
+        #
+        try:
+
+            self.task, delay = advance(self.task, lambda: _clean(remote=self.remote,
+                                                                 clusters=self.clusters,
+                                                                 submit=self._submit,
+                                                                 period=self.period,
+                                                                 wait=self.wait), Rest(self.period))
+
+        except Exception as e:
+
+            logger.warning('Cleaner actor exception: %s' % e)
+            self.task, delay = None, Rest(self.period)
+
+        return delay
+
+    def forget(self, cluster):
+
+        #
+        # - the pass in progress is dropped along with the chain once the last cluster is gone
+        #
+        if not self.clusters:
+            self.task = None
 
     def on_stop(self):
 
-        logger.info('Stopping Cleaner actor for %s' % self.cluster)
+        logger.info('Stopping Cleaner actor for %s' % ', '.join(self.clusters))
 
-def _clean(remote, cluster, period=60.0, wait=10.0):
-    """
-        Cleans dead pods from designated cluster.
-    """ 
+        if self.pool:
+            self.pool.terminate()
 
-    print 'Cleaning cluster %s...' % cluster
+    def _submit(self, cluster, command, indeces):
 
-    #
-    # - Check now if there are dead/stopped pods in this cluster
-    #
-    js = remote('grep %s -j' % cluster)
+        #
+        # - rate limit each cluster, pods left over are picked up again by the next pass
+        #
+        now = time.time()
 
-    if not js['ok']:
+        key = (cluster, command)
 
-        logger.warning('Cleaner: communication with portal during dead check failed (could not grep %s).' % cluster)
-        return
-       
-    data = json.loads(js['out'])
+        if key in self.inflight or now - self.last.get(key, 0) < self.interval:
 
-    dead = [key.split(' #')[-1] for key, val in data.iteritems() if val['process'] == 'dead']
+            logger.debug('Cleaner: holding %s %s -i %s (rate limited)' % (command, cluster, ' '.join(indeces)))
+            return
 
-    stopped = [key.split(' #')[-1] for key, val in data.iteritems() if val['process'] == 'stopped']
+        self.inflight.add(key)
+        self.last[key] = now
+        ref = self.actor_ref
 
-    #
-    # - Check again after wait, and take still-dead/stopped pods
-    #
-    time.sleep(wait)
+        def _reply(outcome):
 
-    js = remote('grep %s -j' % cluster)
+            try:
 
-    if not js['ok']:
+                ref.tell(outcome)
 
-        logger.warning('Cleaner: communication with portal during dead check failed (could not grep %s).' % cluster)
-        return
-       
-    data = json.loads(js['out'])
+            except ActorDeadError:
 
-    dead = list(set(dead) & set([key.split(' #')[-1] for key, val in data.iteritems() if val['process'] == 'dead']))
+                pass
 
-    stopped = list(set(stopped) & set([key.split(' #')[-1] for key, val in data.iteritems() if val['process'] == 'stopped']))
+        self.pool.apply_async(_request, (self.remote, cluster, command, indeces), callback=_reply)
 
-    #
-    # - Kill dead pods
-    #
-    if dead:
+    def _done(self, outcome):
+
+        cluster, command, indeces, js, seconds = outcome['cluster'], outcome['command'], outcome['indeces'], outcome['js'], outcome['seconds']
+        self.inflight.discard((cluster, command))
+        ok = False
+
+        try:
+
+            ok = self._report(cluster, command, indeces, js, seconds)
 
-        js = remote('kill %s -i %s -j' % (cluster, ' '.join(dead)))
+        finally:
+
+            _requests.inc(command=command, outcome='ok' if ok else 'failed')
+
+    def _report(self, cluster, command, indeces, js, seconds):
 
         if not js['ok']:
 
-            logger.warning('Cleaner: could not kill %s -i %s.' % (cluster, ' '.join(dead)))
-            return
-        
+            logger.warning('Cleaner: could not %s %s -i %s.' % (command, cluster, ' '.join(indeces)))
+            return False
+
         data = json.loads(js['out'])
 
-        left = set(map(int, dead)) - set(data[cluster]['down'])
+        if command == 'kill':
+
+            ok = not set(map(int, indeces)) - set(data[cluster]['down'])
+            label, what = 'KILLED', 'dead'
+
+        else:
+
+            ok = data[cluster]['ok']
+            label, what = 'RESET', 'stopped'
 
-        if not left:
+        if ok:
 
-            logger.info('Cleaned (KILLED) %d dead pods for %s SUCCESS. Report:\n%s' % (len(dead), cluster, pprint.pformat(data)))
+            logger.info('Cleaned (%s) %d %s pods for %s SUCCESS in %.2fs. Report:\n%s' % (label, len(indeces), what, cluster, seconds, pprint.pformat(data)))
 
         else:
 
-            logger.warning('Cleaning dead pods for %s FAILED. Report:\n%s' % (cluster, pprint.pformat(data)))
+            logger.warning('Cleaning %s pods for %s FAILED in %.2fs. Report:\n%s' % (what, cluster, seconds, pprint.pformat(data)))
+
+        return ok
+
+def _request(remote, cluster, command, indeces):
+    """
+        Helper issuing one kill/reset request from the pool, returning the outcome as a message for the cleaner.
+        :param remote: function used to pass toolset commands to the portal
+        :param cluster: the glob pattern used to match the cluster
+        :param command: either 'kill' or 'reset'
+        :param indeces: list of pod indeces (as strings)
+    """
+
+    started = time.time()
+
+    try:
+
+        js = remote('%s %s -i %s -j' % (command, cluster, ' '.join(indeces)))
+
+    except Exception as e:
+
+        js = {'ok': False, 'out': str(e)}
+
+    return {'action': 'done', 'cluster': cluster, 'command': command, 'indeces': indeces, 'js': js, 'seconds': time.time() - started}
+
+def _dirty(data, clusters):
+    """
+        Helper sorting the dead & stopped pods of a grep output by cluster glob pattern, splitting each key once.
+        :param data: dict keyed by '<namespace>.<cluster> #<index>' as returned by the portal
+        :param clusters: list of cluster glob patterns
+        :returns: dict of {cluster: ({dead indeces}, {stopped indeces})}
+    """
+
+    names = {}
+
+    for key, status in data.iteritems():
+
+        if status['process'] in ['dead', 'stopped']:
+            name, _, index = key.rpartition(' #')
+            names.setdefault(name, []).append((index, status['process']))
+
+    dirty = {cluster: (set(), set()) for cluster in clusters}
+
+    for name, pods in names.iteritems():
+
+        for cluster in clusters:
+
+            if fnmatch(name, cluster):
+
+                dead, stopped = dirty[cluster]
+
+                for index, process in pods:
+                    (dead if process == 'dead' else stopped).add(index)
+
+    return dirty
+
+def _clean(remote, clusters, submit, period=60.0, wait=10.0):
+    """
+        Cleans dead pods from the designated clusters, all of them at once. This is a generator yielding the number of
+        seconds to pause for (see scheduler.py), its actor being told to resume it once they have elapsed.
+
+        :param remote: function used to pass toolset commands to the portal
+        :param clusters: list of cluster glob patterns
+        :param submit: function issuing a kill or reset request for (cluster, command, indeces)
+        :param period: float number of seconds between passes
+        :param wait: float number of seconds a pod must stay dead/stopped before being cleaned
+    """ 
+
+    print 'Cleaning clusters %s...' % ', '.join(clusters)
+
+    if not clusters:
+
+        yield Rest(period)
+        return
 
     #
-    # - Reset stopped pods
+    # - Check now if there are dead/stopped pods in any of the clusters
     #
-    if stopped:
+    phase('fetch')
+    js = remote('grep %s -j' % ' '.join(clusters))
 
-        js = remote('reset %s -i %s -j' % (cluster, ' '.join(stopped)))
+    if not js['ok']:
 
-        if not js['ok']:
+        logger.warning('Cleaner: communication with portal during dead check failed (could not grep %s).' % ' '.join(clusters))
+        yield Rest(period)
+        return
 
-            logger.warning('Cleaner: could not reset %s -i %s.' % (cluster, ' '.join(stopped)))
-            return
-        
-        data = json.loads(js['out'])
+    phase('analyse')
+    first = _dirty(json.loads(js['out']), clusters)
 
-        if data[cluster]['ok']:
+    #
+    # - Nothing to clean, no need to check again
+    #
+    if not any(dead or stopped for dead, stopped in first.itervalues()):
 
-            logger.info('Cleaned (RESET) %d stopped pods for %s SUCCESS. Report:\n%s' % (len(stopped), cluster, pprint.pformat(data)))
+        yield Rest(period)
+        return
 
-        else:
+    #
+    # - Check again after wait, and take still-dead/stopped pods
+    # - the shared snapshot may well still hold the first grep: expire it for the re-check to be a real one
+    #
+    yield wait
 
-            logger.warning('Cleaning stopped pods for %s FAILED. Report:\n%s' % (cluster, pprint.pformat(data)))
+    if isinstance(remote, Snapshot):
+        remote.expire()
 
-    time.sleep(period - wait)    
+    phase('fetch')
+    js = remote('grep %s -j' % ' '.join(clusters))
+
+    if not js['ok']:
+
+        logger.warning('Cleaner: communication with portal during dead check failed (could not grep %s).' % ' '.join(clusters))
+        yield Rest(period - wait)
+        return
+
+    phase('analyse')
+    second = _dirty(json.loads(js['out']), clusters)
+    phase('act')
+
+    for cluster in clusters:
+
+        dead = first[cluster][0] & second[cluster][0]
+        stopped = first[cluster][1] & second[cluster][1]
+
+        #
+        # - Kill dead pods & reset stopped pods, the requests running concurrently
+        #
+        if dead:
+
+            submit(cluster, 'kill', sorted(dead, key=int))
+
+        if stopped:
+
+            submit(cluster, 'reset', sorted(stopped, key=int))
+
+    yield Rest(period - wait)
 
 if __name__ == '__main__':
 
-    cleaners = []
+    refs = []
+    scheduler = None
+    events = None
 
     try:
 
@@ -178,6 +370,14 @@ if __name__ == '__main__':
             
         period = float(env['PERIOD']) if 'PERIOD' in env else 60
 
+        #
+        # - Number of kill/reset requests in flight at most & minimum number of seconds between two kills (or resets)
+        # - against the same cluster
+        #
+        size = int(env['CLEAN_POOL']) if 'CLEAN_POOL' in env else 8
+        assert size > 0, 'CLEAN_POOL must be at least 1'
+        interval = float(env['CLEAN_INTERVAL']) if 'CLEAN_INTERVAL' in env else 30.0
+
         #
         # - Get the portal that we found during cluster configuration (see pod/pod.py)
         #
@@ -188,51 +388,64 @@ if __name__ == '__main__':
 
         #
         # - Remote for direct communication with the portal
+        # - the connections are pooled and shared by all the actors
+        # - greps are answered from one shared snapshot of the portal, refreshed at most every SNAPSHOT_TTL seconds
         #
-        def _remote(cmdline):
-
-            #
-            # - this block is taken from cli.py in ochothon
-            # - in debug mode the verbatim response from the portal is dumped on stdout
-            #
-            now = time.time()
-            tokens = cmdline.split(' ')
-            files = ['-F %s=@%s' % (basename(token), expanduser(token)) for token in tokens if isfile(expanduser(token))]
-            line = ' '.join([basename(token) if isfile(expanduser(token)) else token for token in tokens])
-            logger.debug('"%s" -> %s' % (line, portal))
-            snippet = 'curl -X POST -H "X-Shell:%s" %s %s/shell' % (line, ' '.join(files), portal)
-            code, lines = shell(snippet)
-            assert code is 0, 'i/o failure (is the proxy portal down ?)'
-            js = json.loads(lines[0])
-            elapsed = time.time() - now
-            logger.debug('<- %s (took %.2f seconds) ->\n\t%s' % (portal, elapsed, '\n\t'.join(js['out'].split('\n'))))
-            return js
+        remote = Snapshot(Portal(portal,
+                                 timeout=float(env['PORTAL_TIMEOUT']) if 'PORTAL_TIMEOUT' in env else 20.0,
+                                 retries=int(env['PORTAL_RETRIES']) if 'PORTAL_RETRIES' in env else 2,
+                                 pool=max(4, size)),
+                          ttl=float(env['SNAPSHOT_TTL']) if 'SNAPSHOT_TTL' in env else 5.0)
 
         #
-        # - Check for overlapping clusters matching all glob patterns
-        #    
-        clusters = []
+        # - Optionally have ZooKeeper tell us as soon as pods change (EVENTS=zk): clusters are then checked right away
+        # - instead of at their next period, polling only reconciling every RECONCILE_PERIOD seconds
+        #
+        mode = env['EVENTS'] if 'EVENTS' in env else 'poll'
+        assert mode in ['poll', 'zk'], 'EVENTS must be either poll or zk'
 
-        for cluster in cleaning:
+        if mode == 'zk':
 
-            js = _remote('grep %s -j' % cluster)
+            events = ZooKeeper(env['OCHOPOD_ZK'], snapshot=remote)
+            events.start()
+            period = float(env['RECONCILE_PERIOD']) if 'RECONCILE_PERIOD' in env else 300.0
 
-            if not js['ok']:
+        #
+        # - Keep the last TRACE_SIZE ticks along with the time spent in each of their phases, written to TRACE_DUMP on
+        # - SIGUSR1 (or fetched from /trace on METRICS_PORT)
+        # - optionally profile one tick out of every PROFILE_EVERY, the cProfile stats being written to PROFILE_DIR
+        #
+        TRACER.configure(size=int(env['TRACE_SIZE']) if 'TRACE_SIZE' in env else 256,
+                         every=int(env['PROFILE_EVERY']) if 'PROFILE_EVERY' in env else 0,
+                         directory=env['PROFILE_DIR'] if 'PROFILE_DIR' in env else '/tmp')
 
-                logger.warning('Cleaner: communication with portal during initialisation failed (could not grep %s).' % cluster)
-                continue
+        install(env['TRACE_DUMP'] if 'TRACE_DUMP' in env else '/tmp/cleaner-trace.json')
 
-            data = json.loads(js['out'])
+        #
+        # - Initialise the supervisor and start
+        # - it expands our glob patterns every DISCOVERY_PERIOD seconds and hands the clusters found over to one
+        # - cleaner actor, which handles them all in a single batched pass every period
+        # - the cleaner is woken up by the scheduler instead of sleeping between its checks
+        #
+        scheduler = Scheduler()
+        discovery = float(env['DISCOVERY_PERIOD']) if 'DISCOVERY_PERIOD' in env else 60.0
+        spawn = lambda clusters: Cleaner.start(remote, scheduler, clusters, period, size=size, interval=interval)
+        refs = [Supervisor.start(scheduler, lambda: expand(remote, cleaning), spawn, period=discovery, workers=1, events=events, globs=cleaning, name='cleaner')]
 
-            clusters += ['%s*' % ' #'.join(key.split(' #')[:-1]) for key in data.keys()]
+        #
+        # - Serve our metrics (portal latencies, ticks, kills & resets...) over HTTP on METRICS_PORT, 0 to disable
+        #
+        port = int(env['METRICS_PORT']) if 'METRICS_PORT' in env else 9100
 
-        clusters = list(set(clusters))
+        if port:
+            REGISTRY.serve(port, routes={'/trace': lambda: ('application/json', json.dumps(TRACER.dump()))})
 
         #
-        # - Initialise the cleaner actors and start
+        # - Stay around to handle signals (only the main thread does), the actors running on their own threads
         #
-        cleaners = [[Cleaner(_remote, cluster, period), cluster] for cluster in clusters]
-        refs = [cleaner.start(_remote, cluster, period) for cleaner, cluster in cleaners]
+        while all(ref.is_alive() for ref in refs):
+
+            time.sleep(1.0)
 
     except Exception as failure:
 
@@ -241,11 +454,19 @@ if __name__ == '__main__':
 
     finally:
 
-        for cleaner in cleaners:
+        if scheduler:
+
+            scheduler.stop()
+
+        if events:
+
+            events.stop()
+
+        for ref in refs:
 
             try:
-                
-                cleaner.stop()
+
+                ref.stop()
 
             except Exception as e:
 
@@ -0,0 +1,148 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+import time
+
+from fnmatch import fnmatch
+from threading import Condition
+from metrics import REGISTRY
+
+logger = logging.getLogger('ochopod')
+
+_requests = REGISTRY.counter('snapshot_requests_total', 'Greps answered from the snapshot, by result (hit, miss or shared).', ['result'])
+
+class Snapshot(object):
+    """
+        Process-wide cache for the portal's view of the pods. A single 'grep * -j' is issued on behalf of all the
+        actors and filtered locally against each of their glob patterns. The snapshot is re-fetched once it is older
+        than the TTL; concurrent callers finding it stale wait on the one request in flight instead of firing their own.
+
+        Instances wrap a remote and are themselves callable: 'grep <glob> [<glob>...] -j' command lines are answered
+        from the snapshot while anything else is passed through to the portal untouched.
+
+        :param remote: function used to pass toolset commands to the portal
+        :param ttl: float number of seconds a snapshot is considered fresh
+    """
+
+    def __init__(self, remote, ttl=5.0):
+
+        self.remote = remote
+        self.ttl = ttl
+        self.cond = Condition()
+
+        #
+        # - last successful snapshot (as a dict) and when it was taken
+        # - flights counts completed fetches, which lets waiters pick the outcome of the one they waited on
+        #
+        self.data = None
+        self.stamp = 0
+        self.pending = False
+        self.flights = 0
+        self.last = None
+
+    def __call__(self, cmdline):
+
+        tokens = cmdline.split()
+
+        if len(tokens) < 3 or tokens[0] != 'grep' or tokens[-1] != '-j' or any(token.startswith('-') for token in tokens[1:-1]):
+
+            return self.remote(cmdline)
+
+        return self.grep(*tokens[1:-1])
+
+    def grep(self, *globs):
+        """
+            Returns the pods matching any of the glob patterns as a {'ok', 'out'} dict, just like the portal would.
+
+            :param globs: glob patterns matching the namespace/clusters
+        """
+
+        data = self.fetch()
+
+        if data is None:
+
+            return {'ok': False, 'out': 'unable to grep the portal'}
+
+        matching = {key: status for key, status in data.iteritems() if any(fnmatch(key.rsplit(' #', 1)[0], glob) for glob in globs)}
+        return {'ok': True, 'out': json.dumps(matching)}
+
+    def fetch(self):
+        """
+            Returns the whole snapshot as a dict, re-fetching it if stale. None is returned if the portal could not be
+            reached.
+        """
+
+        with self.cond:
+
+            if self.data is not None and time.time() - self.stamp < self.ttl:
+
+                _requests.inc(result='hit')
+                return self.data
+
+            if self.pending:
+
+                #
+                # - someone else is already talking to the portal
+                # - wait for that request to complete and use whatever it got us
+                #
+                flight = self.flights
+                while self.flights == flight:
+                    self.cond.wait()
+
+                _requests.inc(result='shared')
+                return self.last
+
+            self.pending = True
+            _requests.inc(result='miss')
+
+        data = None
+        try:
+
+            js = self.remote('grep * -j')
+
+            if js['ok']:
+
+                data = json.loads(js['out'])
+
+            else:
+
+                logger.warning('Snapshot: communication with portal failed (could not grep *).')
+
+        finally:
+
+            with self.cond:
+
+                if data is not None:
+                    self.data = data
+                    self.stamp = time.time()
+
+                self.last = data
+                self.pending = False
+                self.flights += 1
+                self.cond.notify_all()
+
+        return data
+
+    def expire(self):
+        """
+            Marks the snapshot as stale, the next grep re-fetching it (e.g after being told something changed).
+        """
+
+        with self.cond:
+
+            self.stamp = 0
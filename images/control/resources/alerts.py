@@ -0,0 +1,185 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+import time
+
+from itertools import count
+from Queue import Empty, Full, Queue
+from threading import Lock, Thread
+from metrics import REGISTRY
+
+logger = logging.getLogger('ochopod')
+
+_emitted = REGISTRY.counter('watcher_alerts_total', 'Alerts emitted on the watched clusters, by event.', ['event'])
+_dropped = REGISTRY.counter('watcher_alerts_dropped_total', 'Alerts not emitted, by reason (duplicate, rate or full).', ['reason'])
+
+class Alerts(object):
+    """
+        Stream of the watcher alerts, one compact JSON line per event, e.g::
+
+            {"seq":12,"ts":1434582345.2,"cluster":"marathon.web","event":"indeces_lost","indeces":[3,4]}
+
+        Events are sequenced, an event identical to the last one of its kind for the same cluster within window
+        seconds is dropped, and each cluster may emit at most rate events per window (the ones held back are then
+        counted in a 'suppressed' event ahead of the cluster's next one). Emitting never blocks: events are queued (at most size of them, the
+        overflow being dropped and reported in a 'dropped' event) and handed by a background thread to each sink (see
+        sinks.py) in batches of at most batch lines.
+
+        :param sinks: list of started sinks the events are delivered to
+        :param size: int maximum number of events queued
+        :param batch: int maximum number of events handed over at once
+        :param rate: int maximum number of events per cluster per window, 0 for no limit
+        :param window: float number of seconds over which duplicates & rates are assessed
+    """
+
+    def __init__(self, sinks, size=1024, batch=64, rate=10, window=60.0):
+
+        assert size > 0 and batch > 0, 'the alert queue & batches must hold at least 1 event'
+
+        self.sinks = sinks
+        self.batch = batch
+        self.rate = rate
+        self.window = window
+        self.queue = Queue(size)
+        self.lock = Lock()
+        self.seq = count()
+
+        #
+        # - (cluster, event) -> (fields, stamp) of the last event emitted
+        # - cluster -> [window start, events emitted, events held back] for the rate limit
+        # - number of events dropped because the queue was full, yet to be reported
+        #
+        self.last = {}
+        self.budgets = {}
+        self.overflow = 0
+
+    def start(self):
+
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def emit(self, cluster, event, **fields):
+        """
+            Queues an event, returns False if it was dropped.
+
+            :param cluster: '<namespace>.<cluster>' name
+            :param event: event name, e.g 'health'
+            :param fields: event specific fields, which must be JSON serializable
+        """
+
+        now = time.time()
+
+        with self.lock:
+
+            #
+            # - drop repeats of the last event
+            #
+            key = (cluster, event)
+
+            if key in self.last and self.last[key][0] == fields and now - self.last[key][1] < self.window:
+
+                _dropped.inc(reason='duplicate')
+                return False
+
+            #
+            # - fixed window rate limit per cluster, held back events being reported once the window is over
+            #
+            if self.rate:
+
+                budget = self.budgets.get(cluster)
+
+                if budget is None or now - budget[0] >= self.window:
+
+                    if budget and budget[2]:
+                        self._put({'cluster': cluster, 'event': 'suppressed', 'count': budget[2], 'window': self.window}, now)
+
+                    budget = self.budgets[cluster] = [now, 0, 0]
+
+                if budget[1] >= self.rate:
+
+                    budget[2] += 1
+                    _dropped.inc(reason='rate')
+                    return False
+
+                budget[1] += 1
+
+            self.last[key] = (fields, now)
+            record = dict(fields, cluster=cluster, event=event)
+            return self._put(record, now)
+
+    def forget(self, glob):
+        """
+            Drops the duplicate & rate limit state of a cluster no longer watched. Only that exact cluster is
+            forgotten, e.g 'ns.web*' leaves 'ns.web-api' alone.
+
+            :param glob: the cluster glob as handed to the watcher, e.g 'marathon.web*'
+        """
+
+        cluster = glob.rstrip('*')
+
+        with self.lock:
+
+            self.budgets.pop(cluster, None)
+
+            for key in [key for key in self.last if key[0] == cluster]:
+                del self.last[key]
+
+    def _put(self, record, now):
+
+        record.update({'seq': next(self.seq), 'ts': round(now, 3)})
+
+        try:
+
+            self.queue.put_nowait(record)
+            _emitted.inc(event=record['event'])
+            return True
+
+        except Full:
+
+            self.overflow += 1
+            _dropped.inc(reason='full')
+            return False
+
+    def _run(self):
+
+        while True:
+
+            records = [self.queue.get()]
+
+            try:
+
+                while len(records) < self.batch:
+                    records.append(self.queue.get_nowait())
+
+            except Empty:
+
+                pass
+
+            with self.lock:
+
+                overflow, self.overflow = self.overflow, 0
+
+            if overflow:
+                records.append({'seq': next(self.seq), 'ts': round(time.time(), 3), 'event': 'dropped', 'count': overflow})
+
+            lines = [json.dumps(record, separators=(',', ':'), sort_keys=True) for record in records]
+
+            for sink in self.sinks:
+                sink.put(lines)
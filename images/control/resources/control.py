@@ -0,0 +1,257 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+import sys
+import time
+from os import environ
+from ochopod.core.fsm import diagnostic
+from ochopod.core.utils import shell
+from alerts import Alerts
+from cleaner import Cleaner
+from discovery import Supervisor, expand
+from events import ZooKeeper
+from metrics import REGISTRY
+from policy import Policies
+from portal import Portal
+from scaler import PORTS, Scaler, _discover
+from scheduler import Scheduler
+from sinks import create
+from snapshot import Snapshot
+from tracing import TRACER, install
+from watcher import Watcher
+
+logger = logging.getLogger('ochopod')
+
+if __name__ == '__main__':
+
+    refs = []
+    scheduler = None
+    events = None
+
+    try:
+
+        #
+        # - parse our ochopod hints
+        # - enable CLI logging
+        # - pass down the ZK ensemble coordinate
+        #
+        env = environ
+        hints = json.loads(env['ochopod'])
+        env['OCHOPOD_ZK'] = hints['zk']
+
+        #
+        # - the clusters to watch, scale (along with their haproxies) & clean, as for the standalone daemons
+        # - each loop is off unless given some glob patterns
+        #
+        watching = env['DAYCARE'].split(',') if 'DAYCARE' in env else []
+        scalees = env['SCALEES'].split(',') if 'SCALEES' in env else []
+        haproxies = env['HAPROXIES'].split(',') if 'HAPROXIES' in env else []
+        cleaning = env['DIRTY'].split(',') if 'DIRTY' in env else []
+
+        #
+        # - per loop periods, all defaulting to PERIOD
+        #
+        period = float(env['PERIOD']) if 'PERIOD' in env else 60
+        watch_period = float(env['WATCH_PERIOD']) if 'WATCH_PERIOD' in env else period
+        scale_period = float(env['SCALE_PERIOD']) if 'SCALE_PERIOD' in env else period
+        clean_period = float(env['CLEAN_PERIOD']) if 'CLEAN_PERIOD' in env else period
+
+        #
+        # - Number of actors (and thus threads) the watched clusters are spread over
+        #
+        workers = int(env['WORKERS']) if 'WORKERS' in env else 4
+        assert workers > 0, 'WORKERS must be at least 1'
+
+        #
+        # - Number of kill/reset requests in flight at most & minimum number of seconds between two kills (or resets)
+        # - against the same cluster
+        #
+        size = int(env['CLEAN_POOL']) if 'CLEAN_POOL' in env else 8
+        assert size > 0, 'CLEAN_POOL must be at least 1'
+        interval = float(env['CLEAN_INTERVAL']) if 'CLEAN_INTERVAL' in env else 30.0
+
+        discovery = float(env['DISCOVERY_PERIOD']) if 'DISCOVERY_PERIOD' in env else 60.0
+
+        max_age = float(env['HAPROXY_MAX_AGE']) if 'HAPROXY_MAX_AGE' in env else 300.0
+
+        source = env['STATS_SOURCE'] if 'STATS_SOURCE' in env else 'http'
+        assert source in PORTS, 'STATS_SOURCE must be one of %s' % ', '.join(PORTS)
+
+        #
+        # - parse our $pod settings (defined in control.yml)
+        # - HAProxy stats credentials & scaling policies, just like for the scaler
+        #
+        settings = json.loads(env['pod']) if 'pod' in env else {}
+        credentials = settings.get('haproxy', {})
+        auth = (credentials.get('user', 'olivier'), credentials.get('password', 'likeschinesefood'))
+
+        defaults = \
+            {
+                'metrics': {
+                    'rate': {'floor': 5, 'target': 10, 'ceiling': 15},
+                    'threads': {'floor': 5, 'target': 10, 'ceiling': 15},
+                    'qcur': {'slo': 1}
+                },
+                'minimum': int(env['SCALE_MIN']) if 'SCALE_MIN' in env else 1,
+                'maximum': int(env['SCALE_MAX']) if 'SCALE_MAX' in env else 40,
+                'up': float(env['SCALE_UP']) if 'SCALE_UP' in env else 1.0,
+                'down': float(env['SCALE_DOWN']) if 'SCALE_DOWN' in env else 0.5,
+                'up_cooldown': float(env['UP_COOLDOWN']) if 'UP_COOLDOWN' in env else 0.0,
+                'down_cooldown': float(env['DOWN_COOLDOWN']) if 'DOWN_COOLDOWN' in env else 120.0
+            }
+
+        policies = Policies(settings.get('policies', {}), defaults)
+
+        #
+        # - Get the portal that we found during cluster configuration (see pod/pod.py)
+        #
+        _, lines = shell('cat /opt/control/.portal')
+        portal = lines[0]
+        assert portal, '/opt/control/.portal not found (pod not yet configured ?)'
+        logger.debug('using proxy @ %s' % portal)
+
+        from logging.config import fileConfig
+        fileConfig('/opt/control/config/log.cfg', disable_existing_loggers=False)
+
+        #
+        # - Deliver the watcher alerts to each of the ALERTS_SINKS, one compact line per event rate limited per cluster
+        # - (see watcher.py, alerts.py & sinks.py)
+        #
+        options = \
+            {
+                'file': {'path': '/var/log/watcher.log', 'spill': int(env['ALERTS_SPILL']) if 'ALERTS_SPILL' in env else 1048576},
+                'webhook': {'url': env['ALERTS_WEBHOOK'] if 'ALERTS_WEBHOOK' in env else None},
+                'syslog': {'address': env['ALERTS_SYSLOG'] if 'ALERTS_SYSLOG' in env else '/dev/log'}
+            }
+
+        kinds = env['ALERTS_SINKS'].split(',') if 'ALERTS_SINKS' in env else ['file', 'stdout']
+        assert 'webhook' not in kinds or options['webhook']['url'], 'ALERTS_WEBHOOK must be set to use the webhook sink'
+        sinks = create(kinds, options, size=int(env['ALERTS_SINK_QUEUE']) if 'ALERTS_SINK_QUEUE' in env else 4096)
+
+        alerts = Alerts(sinks,
+                        size=int(env['ALERTS_QUEUE']) if 'ALERTS_QUEUE' in env else 1024,
+                        batch=int(env['ALERTS_BATCH']) if 'ALERTS_BATCH' in env else 64,
+                        rate=int(env['ALERTS_RATE']) if 'ALERTS_RATE' in env else 10,
+                        window=float(env['ALERTS_WINDOW']) if 'ALERTS_WINDOW' in env else 60.0).start()
+
+        #
+        # - One remote for all the loops: the portal connections are pooled and every grep is answered from the
+        # - same snapshot, refreshed at most every SNAPSHOT_TTL seconds
+        #
+        remote = Snapshot(Portal(portal,
+                                 timeout=float(env['PORTAL_TIMEOUT']) if 'PORTAL_TIMEOUT' in env else 20.0,
+                                 retries=int(env['PORTAL_RETRIES']) if 'PORTAL_RETRIES' in env else 2,
+                                 pool=max(4, size)),
+                          ttl=float(env['SNAPSHOT_TTL']) if 'SNAPSHOT_TTL' in env else 5.0)
+
+        #
+        # - One scheduler waking up all the actors, whatever loop they run
+        #
+        scheduler = Scheduler()
+
+        #
+        # - Optionally have ZooKeeper tell us as soon as pods change (EVENTS=zk): watched & cleaned clusters are then
+        # - checked right away instead of at their next period, polling only reconciling every RECONCILE_PERIOD seconds
+        #
+        mode = env['EVENTS'] if 'EVENTS' in env else 'poll'
+        assert mode in ['poll', 'zk'], 'EVENTS must be either poll or zk'
+
+        if mode == 'zk':
+
+            events = ZooKeeper(env['OCHOPOD_ZK'], snapshot=remote)
+            events.start()
+            watch_period = clean_period = float(env['RECONCILE_PERIOD']) if 'RECONCILE_PERIOD' in env else 300.0
+
+        #
+        # - Keep the last TRACE_SIZE ticks of all the loops along with the time spent in each of their phases, written
+        # - to TRACE_DUMP on SIGUSR1 (or fetched from /trace on METRICS_PORT)
+        # - optionally profile one tick out of every PROFILE_EVERY per actor, the cProfile stats going to PROFILE_DIR
+        #
+        TRACER.configure(size=int(env['TRACE_SIZE']) if 'TRACE_SIZE' in env else 256,
+                         every=int(env['PROFILE_EVERY']) if 'PROFILE_EVERY' in env else 0,
+                         directory=env['PROFILE_DIR'] if 'PROFILE_DIR' in env else '/tmp')
+
+        install(env['TRACE_DUMP'] if 'TRACE_DUMP' in env else '/tmp/control-trace.json')
+
+        #
+        # - One supervisor per loop, each expanding its glob patterns every DISCOVERY_PERIOD seconds and starting &
+        # - stopping its actors as clusters come and go
+        #
+        if watching:
+
+            max_period = float(env['WATCH_MAX_PERIOD']) if 'WATCH_MAX_PERIOD' in env else 4 * watch_period
+            spawn = lambda group: Watcher.start(remote, scheduler, group, alerts=alerts, period=watch_period, max_period=max_period)
+            refs += [Supervisor.start(scheduler, lambda: expand(remote, watching), spawn, period=discovery, workers=workers, events=events, globs=watching, name='watcher')]
+
+        if scalees:
+
+            spawn = lambda clusters: Scaler.start(remote, scheduler, clusters, policies, scale_period, max_age=max_age, source=source, auth=auth)
+            refs += [Supervisor.start(scheduler, lambda: _discover(remote, scalees, haproxies), spawn, period=discovery, workers=1, name='scaler')]
+
+        if cleaning:
+
+            spawn = lambda clusters: Cleaner.start(remote, scheduler, clusters, clean_period, size=size, interval=interval)
+            refs += [Supervisor.start(scheduler, lambda: expand(remote, cleaning), spawn, period=discovery, workers=1, events=events, globs=cleaning, name='cleaner')]
+
+        assert refs, 'nothing to watch, scale or clean (check DAYCARE, SCALEES/HAPROXIES & DIRTY)'
+        logger.info('Control: running %d loops' % len(refs))
+
+        #
+        # - Serve the metrics of all the loops over HTTP on METRICS_PORT, 0 to disable
+        #
+        port = int(env['METRICS_PORT']) if 'METRICS_PORT' in env else 9100
+
+        if port:
+            REGISTRY.serve(port, routes={'/trace': lambda: ('application/json', json.dumps(TRACER.dump()))})
+
+        #
+        # - The loops live and die together: should any supervisor stop, shut the others down (along with their actors)
+        # - and exit (the pod will then restart us)
+        #
+        while all(ref.is_alive() for ref in refs):
+
+            time.sleep(1.0)
+
+        logger.warning('Control: a loop stopped, shutting down')
+
+    except Exception as failure:
+
+        logger.fatal('Error on line %s' % (sys.exc_info()[-1].tb_lineno))
+        logger.fatal('unexpected condition -> %s' % diagnostic(failure))
+
+    finally:
+
+        if scheduler:
+
+            scheduler.stop()
+
+        if events:
+
+            events.stop()
+
+        for ref in refs:
+
+            try:
+
+                ref.stop()
+
+            except Exception as e:
+
+                pass
+
+        sys.exit(1)
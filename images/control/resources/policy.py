@@ -0,0 +1,256 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import math
+import time
+
+from fnmatch import fnmatch
+from forecast import Holt
+from stats import QUEUES, TIMERS
+
+logger = logging.getLogger('ochopod')
+
+#
+# - how the metrics of a policy combine when deciding to scale up or down
+#
+RULES = {'any': any, 'all': all}
+
+class Policy(object):
+    """
+        Proportional scaling policy. Each metric has a per-pod floor, target and ceiling: when the metrics go above their
+        ceiling (or drop below their floor) as per the up & down rules, the number of pods is set directly to what brings
+        every metric back to its target, e.g ceil(total session rate / target session rate per pod). Steps are then
+        capped to a fraction of the current size, clamped within [minimum, maximum] and subject to separate up & down
+        cooldowns.
+
+        Metrics can also be given as a service level objective, e.g {'slo': 500} for rtime to keep the backend response
+        time under 500 ms, or {'slo': 1} for qcur to keep the queue close to empty. The SLO is then used as both ceiling
+        and target, and the metric stops holding back a scale down once it is within headroom x SLO (half of it by
+        default), zero included.
+
+        A metric with a step (1 by default for the HAProxy queue) only tells that the cluster is short of pods, not by
+        how many: it does not size the cluster and asks for step more pods whenever it goes above its ceiling. Requests
+        piling up in the queue have no bearing on how much load each pod can take.
+
+        Optionally the load of each metric is forecast a little ahead (typically the time it takes a pod to boot) from
+        its history across periods, and the policy acts on the forecast whenever it is higher than the current load.
+        This pre-scales ahead of a ramp instead of reacting once it has started.
+
+        :param metrics: dict of {metric: {'floor': x, 'target': y, 'ceiling': z}} or {metric: {'slo': x, 'headroom': y}},
+                        per running pod unless 'per_pod' is false in which case the metric is taken as is (e.g HAProxy
+                        timings & queue), optionally with a 'step' (int number of pods) to use it as a trigger only
+        :param rules: dict of {'up': rule, 'down': rule}, rule being 'any' or 'all' of the metrics crossing their threshold
+        :param minimum: int minimum number of pods
+        :param maximum: int maximum number of pods
+        :param up: float maximum step up, as a fraction of the current number of pods (1.0 allows doubling)
+        :param down: float maximum step down, as a fraction of the current number of pods
+        :param up_cooldown: float number of seconds to wait after any scaling before scaling up again
+        :param down_cooldown: float number of seconds to wait after any scaling before scaling down again
+        :param forecast: optional dict of {'horizon': seconds, 'alpha': x, 'beta': y, 'history': samples} (see Holt),
+                         forecasting being off unless horizon is > 0
+    """
+
+    def __init__(self, metrics, rules=None, minimum=1, maximum=40, up=1.0, down=0.5, up_cooldown=0.0, down_cooldown=120.0, forecast=None):
+
+        rules = rules or {}
+
+        for metric, thresholds in metrics.iteritems():
+
+            if 'slo' in thresholds:
+
+                assert thresholds['slo'] > 0, 'metric %s needs a positive slo' % metric
+                thresholds.update({
+                    'floor': thresholds['slo'] * thresholds.get('headroom', 0.5),
+                    'target': thresholds['slo'],
+                    'ceiling': thresholds['slo']
+                })
+
+            assert all(key in thresholds for key in ['floor', 'target', 'ceiling']), 'metric %s needs a floor, target & ceiling' % metric
+            thresholds.setdefault('per_pod', metric not in TIMERS + QUEUES)
+            thresholds.setdefault('step', 1 if metric in QUEUES else 0)
+            assert thresholds['step'] >= 0, 'metric %s needs a positive step' % metric
+
+        assert all(rules.get(key, 'any') in RULES for key in ['up', 'down']), 'rules must be one of %s' % ', '.join(RULES)
+
+        self.metrics = metrics
+        self.rules = {'up': RULES[rules.get('up', 'any')], 'down': RULES[rules.get('down', 'all')]}
+        self.minimum = minimum
+        self.maximum = maximum
+        self.up = up
+        self.down = down
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.forecast = forecast if forecast and forecast.get('horizon', 0) > 0 else None
+
+        #
+        # - cluster -> time of its last scaling
+        # - (cluster, metric) -> load forecaster
+        #
+        self.last = {}
+        self.models = {}
+
+    def replicas(self, cluster, current, running, loads, now=None):
+        """
+            Returns the number of pods the cluster should be scaled to (which is current if nothing should be done).
+
+            :param cluster: the glob pattern used to match the cluster
+            :param current: int number of pods in the cluster
+            :param running: int number of pods whose sub-process is running (and thus taking load)
+            :param loads: dict of {metric: average load per running pod}, metrics without thresholds are ignored
+            :param now: optional timestamp, defaults to the current time
+        """
+
+        now = now if now is not None else time.time()
+        loads = {metric: load for metric, load in loads.iteritems() if metric in self.metrics}
+
+        if not loads or not running:
+
+            return current
+
+        if self.forecast:
+
+            loads = {metric: max(load, self._forecast(cluster, metric, load, running, now)) for metric, load in loads.iteritems()}
+
+        over = self.rules['up'](load > self.metrics[metric]['ceiling'] for metric, load in loads.iteritems())
+        under = self.rules['down'](self._under(metric, load) for metric, load in loads.iteritems())
+
+        if not over and not under:
+
+            return current
+
+        #
+        # - pods needed to bring each metric back to its target, the most demanding one wins
+        # - metrics with a step only ask for that many more pods when above their ceiling and never size the cluster down
+        #
+        sizes = [int(math.ceil(float(load) * running / self.metrics[metric]['target'])) for metric, load in loads.iteritems() if not self.metrics[metric]['step']]
+        sizes += [current + self.metrics[metric]['step'] for metric, load in loads.iteritems() if self.metrics[metric]['step'] and load > self.metrics[metric]['ceiling']]
+
+        if not sizes:
+
+            return current
+
+        desired = max(sizes)
+        desired = max(desired, current) if over else min(desired, current)
+
+        #
+        # - cap the step (always allowing at least one pod) & clamp within our bounds
+        #
+        if desired > current:
+
+            desired = min(desired, current + max(1, int(math.ceil(current * self.up))))
+
+        else:
+
+            desired = max(desired, current - max(1, int(math.floor(current * self.down))))
+
+        desired = min(max(desired, self.minimum), self.maximum)
+
+        #
+        # - honor the cooldowns
+        #
+        elapsed = now - self.last.get(cluster, 0)
+
+        if (desired > current and elapsed < self.up_cooldown) or (desired < current and elapsed < self.down_cooldown):
+
+            logger.debug('Policy: %s cooling down (%d -> %d held)' % (cluster, current, desired))
+            return current
+
+        if desired != current:
+
+            self.last[cluster] = now
+
+        return desired
+
+    def _under(self, metric, load):
+
+        #
+        # - SLO metrics count as under their floor when reaching it (a queue of 0 is as good as it gets)
+        #
+        thresholds = self.metrics[metric]
+        return load <= thresholds['floor'] if 'slo' in thresholds else load < thresholds['floor']
+
+    def _forecast(self, cluster, metric, load, running, now):
+
+        #
+        # - forecast the load of the whole cluster (per pod loads would drop each time we scale up)
+        # - and bring it back per running pod
+        #
+        per_pod = self.metrics[metric]['per_pod']
+        key = (cluster, metric)
+
+        if key not in self.models:
+            self.models[key] = Holt(**{setting: value for setting, value in self.forecast.iteritems() if setting != 'horizon'})
+
+        model = self.models[key]
+        model.add(load * running if per_pod else load, now)
+        predicted = model.forecast(self.forecast['horizon'])
+
+        if model.error is not None:
+            logger.info('Policy: %s %s forecast in %ds -> %.2f (error %.0f%%)' % (cluster, metric, self.forecast['horizon'], predicted, 100 * model.error))
+
+        return predicted / running if per_pod else predicted
+
+class Policies(object):
+    """
+        Scaling policies by cluster glob pattern, as defined in the scaler settings, e.g::
+
+            policies:
+              default:
+                metrics:
+                  rate: {floor: 5, target: 10, ceiling: 15}
+              marathon.batch*:
+                maximum: 100
+                rules: {up: all, down: all}
+                metrics:
+                  qcur: {floor: 0, target: 1, ceiling: 5}
+                  threads: {floor: 5, target: 10, ceiling: 15}
+
+        Clusters matching none of the glob patterns use the 'default' policy.
+
+        :param settings: dict of {glob: policy settings}
+        :param defaults: dict of policy settings (see Policy) every definition is applied over
+    """
+
+    def __init__(self, settings, defaults):
+
+        def _policy(spec):
+            merged = dict(defaults)
+            merged.update(spec)
+            return Policy(**merged)
+
+        self.default = _policy(settings.get('default', {}))
+        self.policies = [(glob, _policy(spec)) for glob, spec in settings.iteritems() if glob != 'default']
+
+    def get(self, cluster):
+        """
+            Returns the policy for a cluster.
+            :param cluster: the glob pattern used to match the cluster
+        """
+
+        for glob, policy in self.policies:
+
+            if fnmatch(cluster.rstrip('*'), glob):
+                return policy
+
+        return self.default
+
+    def metrics(self):
+        """
+            Returns the set of metrics used across all the policies.
+        """
+
+        return set(metric for _, policy in self.policies + [('default', self.default)] for metric in policy.metrics)
@@ -0,0 +1,653 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+import sys
+import time
+import requests
+import stats
+from policy import Policies
+from fnmatch import fnmatch
+from os import environ
+from subprocess import Popen, PIPE
+from ochopod.core.fsm import diagnostic
+from ochopod.core.utils import retry, shell
+from discovery import Supervisor, expand
+from metrics import REGISTRY
+from portal import Portal
+from scheduler import Scheduler, advance
+from snapshot import Snapshot
+from tracing import TRACER, install, phase
+from pykka import ThreadingActor, ThreadingFuture, Timeout, ActorRegistry
+from pykka.exceptions import ActorDeadError
+
+logger = logging.getLogger('ochopod')
+
+#
+# - HAProxy stats ports for each stats source (see frontend.cfg in the haproxy pod)
+#
+PORTS = {'http': 9002, 'socket': 9003}
+
+_ticks = REGISTRY.histogram('actor_tick_seconds', 'Time spent by the actors on each tick.', ['actor'])
+_fetch = REGISTRY.histogram('haproxy_fetch_seconds', 'Latency of the HAProxy stats fetches, retries included.', ['source'])
+_decisions = REGISTRY.counter('scaler_decisions_total', 'Scale requests sent, by direction.', ['direction'])
+_targets = REGISTRY.gauge('scaler_target_pods', 'Number of pods last deemed necessary for each cluster.', ['cluster'])
+
+class Scaler(ThreadingActor):
+
+    def __init__(self, remote, scheduler, scalees, policies, period=30.0, reps=5, max_age=300.0, source='http', auth=None):
+
+            super(Scaler, self).__init__() 
+
+            self.remote = remote
+            self.scheduler = scheduler
+            self.scalees = scalees
+            self.policies = policies
+            self.period = period
+            self.reps = reps
+            self.source = source
+            self.auth = auth
+            self.endpoints = Endpoints(remote, port=PORTS[source], max_age=max_age)
+            self.task = None
+
+    def on_start(self):
+
+        logger.info('Starting Scaler for %s...' % ', '.join(cluster for cluster, _ in self.scalees))
+        self.actor_ref.tell({'action': 'scale'})
+
+    def on_receive(self, msg):
+
+        #
+        # - clusters coming & going (see discovery.py), the changes apply from the next pass on
+        #
+        if 'action' in msg and msg['action'] == 'add':
+
+            self.scalees = sorted(set(self.scalees) | set(msg['clusters']))
+
+        elif 'action' in msg and msg['action'] == 'remove':
+
+            self.scalees = sorted(set(self.scalees) - set(msg['clusters']))
+
+        elif 'action' in msg and msg['action'] == 'scale':
+
+            #
+            # - run the scaling pass up to its next pause and have the scheduler wake us up once it is over
+            #
+            try:
+
+                with _ticks.time(actor='scaler'), TRACER.tick('scaler', 'scalees') as traced:
+
+                    self.task, delay = advance(self.task, lambda: _proxyscale(remote=self.remote,
+                                                                              scalees=self.scalees,
+                                                                              policies=self.policies,
+                                                                              endpoints=self.endpoints,
+                                                                              source=self.source,
+                                                                              auth=self.auth,
+                                                                              period=self.period,
+                                                                              reps=self.reps), self.period)
+                    traced.sleep = delay
+
+            except Exception as e:
+
+                logger.warning('Scaler actor exception: %s' % e)
+                self.task, delay = None, self.period
+
+            self.scheduler.tell(delay, self.actor_ref, {'action': 'scale'})
+
+    def on_stop(self):
+
+        logger.info('Stopping Scaler actor for %s' % ', '.join(cluster for cluster, _ in self.scalees))
+
+def output(js, cluster, target):
+    """
+        Helper for logging results from scale requests.
+        :param js: jsonified output returned from a request to the portal using shell().
+        :param cluster: the glob pattern used to match a cluster
+    """
+
+    if not js['ok']:
+
+        logger.warning('Communication with portal when trying to scale clusters under %s FAILED.' % cluster)
+        return
+
+    data = json.loads(js['out'])
+    failed = any([not scaled['ok'] for key, scaled in data.iteritems()]) 
+       
+    import pprint
+
+    if failed:
+
+        logger.warning('Scaling %s FAILURE. Report:\n%s' % (cluster, pprint.pformat(data)))
+
+    else:
+
+        logger.info('Scaling %s to %d instances SUCCESS. Report:\n%s' % (cluster, target, pprint.pformat(data)))
+
+class Endpoints(object):
+    """
+        Cache for the HAProxy stats endpoints, keyed by haproxy glob pattern. An endpoint is looked up again through
+        the portal only when a stats fetch against it failed, when the pods matching the glob changed or when it is
+        older than max_age.
+
+        :param remote: function used to pass toolset commands to the portal
+        :param port: int stats port to look up (see PORTS)
+        :param max_age: float number of seconds after which an endpoint is looked up again regardless
+    """
+
+    def __init__(self, remote, port=9002, max_age=300.0):
+
+        self.remote = remote
+        self.port = port
+        self.max_age = max_age
+        self.cache = {}
+
+    def get(self, haproxy, topology=None):
+        """
+            Returns the <ip>:<port> stats endpoint for the haproxy, or None if it could not be found.
+            :param haproxy: glob pattern matching the haproxy
+            :param topology: sorted list of the pod keys currently matching the glob, None if unknown
+        """
+
+        if haproxy in self.cache:
+
+            url, stamp, known = self.cache[haproxy]
+
+            if time.time() - stamp < self.max_age and (topology is None or topology == known):
+
+                return url
+
+            logger.debug('HAProxy %s changed or expired, looking it up again' % haproxy)
+
+        url = _locate(self.remote, haproxy, self.port)
+
+        if url:
+
+            self.cache[haproxy] = (url, time.time(), topology)
+
+        else:
+
+            self.invalidate(haproxy)
+
+        return url
+
+    def invalidate(self, haproxy):
+        """
+            Drops the endpoint for the haproxy, forcing a lookup on the next get().
+            :param haproxy: glob pattern matching the haproxy
+        """
+
+        self.cache.pop(haproxy, None)
+
+def _match(data, cluster):
+    """
+        Helper picking the entries of a grep/poll output belonging to a cluster glob pattern.
+        :param data: dict keyed by '<namespace>.<cluster> #<index>' as returned by the portal
+        :param cluster: the glob pattern used to match a cluster
+    """
+
+    return {key: item for key, item in data.iteritems() if fnmatch(key.rsplit(' #', 1)[0], cluster)}
+
+def _discover(remote, scalees, haproxies):
+    """
+        Helper expanding the scalee glob patterns into (cluster, haproxy) glob pattern pairs, one per distinct cluster.
+        None is returned if the portal could not be reached.
+        :param remote: function used to pass toolset commands to the portal
+        :param scalees: list of scalee glob patterns
+        :param haproxies: list of haproxy glob patterns, one per scalee glob pattern
+    """
+
+    found = set()
+
+    for cluster, haproxy in zip(scalees, haproxies):
+
+        clusters = expand(remote, [cluster])
+
+        if clusters is None:
+
+            return None
+
+        found |= set((glob, haproxy) for glob in clusters)
+
+    return found
+
+def _locate(remote, haproxy, port=9002):
+    """
+        Helper looking up the HAProxy stats endpoint (TCP 9002 or 9003 for the stats socket) through the portal.
+        :param remote: function used to pass toolset commands to the portal
+        :param haproxy: glob pattern matching the haproxy
+        :param port: int stats port to look up
+    """
+
+    js = remote('port %d %s -j' % (port, haproxy))
+
+    if not js['ok']:
+
+        logger.warning('Communication with portal when looking for HAProxy %s FAILED' % haproxy)
+        return None
+
+    outs = json.loads(js['out'])
+
+    if not len(outs) == 1:
+
+        logger.warning('Did not find 1 HAProxy under %s (found %d)' % (haproxy, len(outs)))
+        return None
+
+    key = outs.keys()[0]
+
+    return '%s:%s' % (outs[key]['ip'], outs[key]['ports'])
+
+@retry(timeout=5.0, pause=0.5)
+def _stats(url, source='http', auth=None):
+    """
+        Gets the stats from HAproxy. This will parse the csv-formatted stats for the 'local' proxy (its BACKEND and
+        each of its servers) into a Stats object. Look at the haproxy pod for more info (frontend.cfg and local.cfg).
+        :param url: <ip>:<port> for the HAProxy stats page or socket
+        :param source: 'http' to read the stats page, 'socket' to use 'show stat' on the stats socket
+        :param auth: (user, password) tuple for the stats page
+    """
+
+    if source == 'socket':
+
+        #
+        # - only dump the backends and servers (the 'local' backend is all we need)
+        #
+        return stats.Socket(url, types=6).fetch(proxies=['local'])
+
+    return stats.HTTP(url, auth=auth).fetch(proxies=['local'])
+
+def _proxyscale(remote, scalees, policies, endpoints, source='http', auth=None, period=300.0, reps=5):
+    """
+        Scales clusters under provided cluster glob patterns according to their load. This is checked through HAproxy pods.
+        All the scalees are handled in one batched pass: each repetition issues one grep and one poll for all of them and
+        fetches each distinct HAProxy stats page once, then every scaling decision is taken from that shared data.
+
+        This is a generator yielding the number of seconds to pause for (see scheduler.py), its actor being told to resume it
+        once they have elapsed.
+
+        Each cluster is scaled according to its policy (see policy.py), which picks its metrics amongst the HAProxy BACKEND
+        columns (rate, scur, qcur, rtime...) and any key reported by the scalees' sanity_check(), summed over the pods.
+
+        This example also uses user-defined metrics; the scalees have threaded Flask servers that keep track of the number of open 
+        threaded requests at a /threads endpoint. The sanity_check() metrics are::
+
+            from random import choice
+            from ochopod.core.utils import merge, retry
+
+            cwd = '/opt/flask'
+            checks = 5
+            check_every = 1
+            metrics = True
+
+            def sanity_check(self, pid):
+                
+                #
+                # - Randomly decide to be stressed  
+                # - Curl to Flask in the subprocess to check number of threaded requests running.
+                #
+                @retry(timeout=30.0, pause=0)
+                def _self_curl():
+                    reply = get('http://localhost:9000/threads')
+                    code = reply.status_code
+                    assert code == 200 or code == 201, 'Self curling failed'
+                    return merge({'stressed': choice(['Very', 'Nope'])}, json.loads(reply.text))
+
+                return _self_curl()
+
+        General usage for this function:
+        :param remote: function used to pass toolset commands to the portal
+        :param scalees: list of (cluster, haproxy) glob pattern pairs, each haproxy corresponding to its scalee cluster
+        :param policies: Policies computing the number of pods each cluster should be scaled to
+        :param endpoints: Endpoints cache used to resolve the HAProxy stats pages
+        :param source: where the HAProxy stats are read from, either 'http' or 'socket'
+        :param auth: (user, password) tuple for the HAProxy stats pages
+        :param period: period (secs) to wait before polling for metrics and scaling
+        :param reps: int number of 1-second poll repetitions to get stats from HAProxy
+    """ 
+
+    assert period > reps, "A period of %d seconds doesn't allow for %d x 1 second polling repetitions." % (period, reps)
+
+    #
+    # - Check stats this many times to get an average of session rate (since HAProxy only uses 1 second intervals)
+    # - I.e. 5 repetitions averages session rates 5 times with a 1 sec sleep between
+    #
+    reps = reps
+
+    #
+    # - If pods were recently scaled, sleep for half the time to re-poll cluster status quickly
+    #
+    recent = False
+
+    #
+    # - Find our HAProxy instances (once for each distinct glob)
+    # - the endpoints are cached and only looked up again if the haproxy pods have changed
+    #
+    phase('fetch')
+    haproxies = set(haproxy for _, haproxy in scalees)
+    js = remote('grep %s -j' % ' '.join(haproxies)) if haproxies else {'ok': False}
+    topology = json.loads(js['out']) if js['ok'] else None
+    urls = {haproxy: endpoints.get(haproxy, sorted(_match(topology, haproxy)) if topology is not None else None) for haproxy in haproxies}
+    scalees = [(cluster, haproxy) for cluster, haproxy in scalees if urls[haproxy]]
+    clusters = ' '.join(cluster for cluster, _ in scalees)
+
+    #
+    # - Per cluster: average of each metric its policy uses (e.g sessions/second rate or number of open threads in
+    # - Flask servers), number of Flasks, number of running Flasks and number of samples taken, over reps # of repetitions
+    #
+    averages = {cluster: {'metrics': {}, 'num': 0, 'running': 0, 'samples': 0} for cluster, _ in scalees}
+
+    for i in range(reps if scalees else 0):
+
+        yield 1
+
+        #
+        # - Number of pods up & number of pods with running sub processes, for all the scalees at once
+        #
+        phase('fetch')
+        js = remote('grep %s -j' % clusters)
+        
+        if not js['ok']:
+
+            logger.warning('Communication with portal during pre-scale grep FAILED.')
+            continue
+
+        pods = json.loads(js['out'])
+
+        #
+        # - User-defined metrics (e.g threads) for all the scalees at once
+        #
+        js = remote('poll %s -j' % clusters)
+        
+        if not js['ok']:
+
+            logger.warning('Communication with portal during metrics gathering FAILED.')
+            continue
+        
+        metrics = json.loads(js['out'])
+
+        #
+        # - Get the stats from each HAproxy once
+        # - Look at the haproxy pod for more info (frontend.cfg and local.cfg) 
+        #
+        backends = {}
+
+        for haproxy, url in urls.items():
+
+            try:
+
+                if url:
+
+                    with _fetch.time(source=source):
+
+                        backends[haproxy] = _stats(url, source, auth).backends.get('local')
+
+                else:
+
+                    backends[haproxy] = None
+
+            except Exception as e:
+
+                #
+                # - skip that HAProxy for the rest of the pass, its clusters are simply not scaled this time
+                # - the other clusters are not held up by a dead HAProxy timing out on each repetition
+                #
+                logger.warning('Polling HAProxy %s FAILED (%s)' % (haproxy, e))
+                endpoints.invalidate(haproxy)
+                urls[haproxy] = None
+
+        phase('analyse')
+
+        for cluster, haproxy in scalees:
+
+            #
+            # - each cluster is analysed on its own, a failure (e.g a non numeric metric) only skipping that sample
+            #
+            try:
+
+                outs = _match(pods, cluster)
+                ok = sum(1 for key, data in outs.iteritems() if data['process'] == 'running')
+                averages[cluster]['num'] = len(outs)
+                averages[cluster]['running'] = ok
+
+                #
+                # - Nothing is running yet, try again next time
+                #
+                if ok == 0:
+
+                    logger.warning('Did not find running scalees under %s.' % cluster)
+                    continue
+
+                if not backends.get(haproxy):
+
+                    continue
+
+                #
+                # - Running averages for each metric of the cluster's policy
+                # - HAProxy columns are read off the BACKEND, anything else is summed over the scalees' metrics
+                # - totals are divided by the number of running pods, unless the policy says otherwise
+                #
+                polled = _match(metrics, cluster)
+                values = {}
+
+                for metric, thresholds in policies.get(cluster).metrics.iteritems():
+
+                    if metric in stats.FIELDS:
+
+                        value = float(getattr(backends[haproxy], metric))
+
+                    else:
+
+                        value = float(sum(item[metric] for key, item in polled.iteritems() if metric in item))
+
+                    values[metric] = value / ok if thresholds['per_pod'] else value
+
+                n = averages[cluster]['samples'] = averages[cluster]['samples'] + 1
+
+                for metric, value in values.iteritems():
+
+                    average = averages[cluster]['metrics'].get(metric, 0)
+                    averages[cluster]['metrics'][metric] = average + (value - average)/n
+
+            except Exception as e:
+
+                logger.warning('Scaler could not analyse %s (%s)' % (cluster, e))
+                continue
+
+    for cluster, _ in scalees:
+
+        phase('decide')
+        loads = averages[cluster]['metrics']
+        num = averages[cluster]['num']
+
+        if not averages[cluster]['samples']:
+
+            continue
+
+        #
+        # - each cluster is scaled on its own, a failure (e.g the portal failing the scale) not holding up the others
+        #
+        try:
+
+            logger.info('Scaler gathered metrics for %s --> %s' % (cluster, ', '.join('average %s: %.2f' % (metric, load) for metric, load in sorted(loads.items()))))
+
+            #
+            # - Scale up/down based on how stressed the cluster is, straight to the number of pods
+            # - the policy deems necessary
+            #
+            target = policies.get(cluster).replicas(cluster, num, averages[cluster]['running'], loads)
+            _targets.set(target, cluster=cluster.rstrip('*'))
+
+            if target != num:
+
+                phase('act')
+                _decisions.inc(direction='up' if target > num else 'down')
+                recent = True
+                js = remote('scale %s -f @%d -j' % (cluster, target))
+
+                #
+                # - Output for calls to scale
+                #
+                output(js, cluster, target)
+
+        except Exception as e:
+
+            logger.warning('Scaler could not scale %s (%s)' % (cluster, e))
+            continue
+
+    #
+    # - Wait for period minus polling reps
+    #
+    yield period - reps if not recent else period/2 - reps
+
+if __name__ == '__main__':
+
+    refs = []
+    scheduler = None
+
+    try:
+
+        #
+        # - parse our ochopod hints
+        # - enable CLI logging
+        # - pass down the ZK ensemble coordinate
+        #
+        env = environ
+        hints = json.loads(env['ochopod'])
+        env['OCHOPOD_ZK'] = hints['zk']
+        
+        #
+        # - Check for passed set of scalee clusters, haproxies, and time period in deployment yaml
+        #
+        scalees = env['SCALEES'].split(',') if 'SCALEES' in env else []
+
+        haproxies = env['HAPROXIES'].split(',') if 'HAPROXIES' in env else []
+            
+        period = float(env['PERIOD']) if 'PERIOD' in env else 60
+
+        max_age = float(env['HAPROXY_MAX_AGE']) if 'HAPROXY_MAX_AGE' in env else 300.0
+
+        source = env['STATS_SOURCE'] if 'STATS_SOURCE' in env else 'http'
+        assert source in PORTS, 'STATS_SOURCE must be one of %s' % ', '.join(PORTS)
+
+        #
+        # - parse our $pod settings (defined in scaler.yml)
+        # - HAProxy stats credentials (see frontend.cfg in the haproxy pod)
+        #
+        settings = json.loads(env['pod']) if 'pod' in env else {}
+        credentials = settings.get('haproxy', {})
+        auth = (credentials.get('user', 'olivier'), credentials.get('password', 'likeschinesefood'))
+
+        #
+        # - Scaling policies, by cluster glob pattern: each defines its metrics and their thresholds PER POD, the rules
+        # - combining them, bounds, max step sizes and cooldowns
+        # - the default policy scales on the session rate (sessions/second -- see HAProxy stats parameters), the
+        # - open threads (if using flask samples) and keeps the HAProxy queue close to empty
+        # - bounds, step sizes and cooldowns default to the environment
+        #
+        defaults = \
+            {
+                'metrics': {
+                    'rate': {'floor': 5, 'target': 10, 'ceiling': 15},
+                    'threads': {'floor': 5, 'target': 10, 'ceiling': 15},
+                    'qcur': {'slo': 1}
+                },
+                'minimum': int(env['SCALE_MIN']) if 'SCALE_MIN' in env else 1,
+                'maximum': int(env['SCALE_MAX']) if 'SCALE_MAX' in env else 40,
+                'up': float(env['SCALE_UP']) if 'SCALE_UP' in env else 1.0,
+                'down': float(env['SCALE_DOWN']) if 'SCALE_DOWN' in env else 0.5,
+                'up_cooldown': float(env['UP_COOLDOWN']) if 'UP_COOLDOWN' in env else 0.0,
+                'down_cooldown': float(env['DOWN_COOLDOWN']) if 'DOWN_COOLDOWN' in env else 120.0
+            }
+
+        policies = Policies(settings.get('policies', {}), defaults)
+
+        #
+        # - Get the portal that we found during cluster configuration (see pod/pod.py)
+        #
+        _, lines = shell('cat /opt/scaler/.portal')
+        portal = lines[0]
+        assert portal, '/opt/scaler/.portal not found (pod not yet configured ?)'
+        logger.debug('using proxy @ %s' % portal)
+
+        #
+        # - Remote for direct communication with the portal
+        # - the connections are pooled and shared by all the actors
+        # - greps are answered from one shared snapshot of the portal, refreshed at most every SNAPSHOT_TTL seconds
+        #
+        remote = Snapshot(Portal(portal,
+                                 timeout=float(env['PORTAL_TIMEOUT']) if 'PORTAL_TIMEOUT' in env else 20.0,
+                                 retries=int(env['PORTAL_RETRIES']) if 'PORTAL_RETRIES' in env else 2),
+                          ttl=float(env['SNAPSHOT_TTL']) if 'SNAPSHOT_TTL' in env else 5.0)
+
+        #
+        # - Keep the last TRACE_SIZE ticks along with the time spent in each of their phases, written to TRACE_DUMP on
+        # - SIGUSR1 (or fetched from /trace on METRICS_PORT)
+        # - optionally profile one tick out of every PROFILE_EVERY, the cProfile stats being written to PROFILE_DIR
+        #
+        TRACER.configure(size=int(env['TRACE_SIZE']) if 'TRACE_SIZE' in env else 256,
+                         every=int(env['PROFILE_EVERY']) if 'PROFILE_EVERY' in env else 0,
+                         directory=env['PROFILE_DIR'] if 'PROFILE_DIR' in env else '/tmp')
+
+        install(env['TRACE_DUMP'] if 'TRACE_DUMP' in env else '/tmp/scaler-trace.json')
+
+        #
+        # - Initialise the supervisor and start
+        # - it expands our glob patterns every DISCOVERY_PERIOD seconds and hands the clusters found over to one
+        # - scaler actor, which handles them all in a single batched pass every period
+        # - the scaler is woken up by the scheduler instead of sleeping between its polls
+        #
+        scheduler = Scheduler()
+        discovery = float(env['DISCOVERY_PERIOD']) if 'DISCOVERY_PERIOD' in env else 60.0
+        spawn = lambda clusters: Scaler.start(remote, scheduler, clusters, policies, period, max_age=max_age, source=source, auth=auth)
+        refs = [Supervisor.start(scheduler, lambda: _discover(remote, scalees, haproxies), spawn, period=discovery, workers=1, name='scaler')]
+
+        #
+        # - Serve our metrics (portal & HAProxy latencies, ticks, decisions...) over HTTP on METRICS_PORT, 0 to disable
+        #
+        port = int(env['METRICS_PORT']) if 'METRICS_PORT' in env else 9100
+
+        if port:
+            REGISTRY.serve(port, routes={'/trace': lambda: ('application/json', json.dumps(TRACER.dump()))})
+
+        #
+        # - Stay around to handle signals (only the main thread does), the actors running on their own threads
+        #
+        while all(ref.is_alive() for ref in refs):
+
+            time.sleep(1.0)
+
+    except Exception as failure:
+
+        logger.fatal('Error on line %s' % (sys.exc_info()[-1].tb_lineno))
+        logger.fatal('unexpected condition -> %s' % diagnostic(failure))
+
+    finally:
+
+        if scheduler:
+
+            scheduler.stop()
+
+        for ref in refs:
+
+            try:
+
+                ref.stop()
+
+            except Exception as e:
+
+                pass
+
+        sys.exit(1)
\ No newline at end of file
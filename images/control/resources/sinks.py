@@ -0,0 +1,249 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import sys
+import time
+
+from logging import Formatter, INFO, makeLogRecord
+from logging.handlers import RotatingFileHandler, SysLogHandler
+from Queue import Empty, Full, Queue
+from threading import Thread
+from requests import Session
+from metrics import REGISTRY
+
+logger = logging.getLogger('ochopod')
+
+_latency = REGISTRY.histogram('watcher_sink_seconds', 'Time taken to deliver a batch of alerts, by sink.', ['sink'])
+_dropped = REGISTRY.counter('watcher_sink_dropped_total', 'Alert lines a sink gave up on, by sink and reason (full or failed).', ['sink', 'reason'])
+
+class Sink(object):
+    """
+        Base class for the destinations the watcher alerts are delivered to (see alerts.py). Each sink runs its own
+        thread: put() only queues the lines (at most size of them, the overflow being dropped) and the thread delivers
+        them in batches of at most batch lines. A failed batch is retried with an exponential backoff, up to retries
+        times, before being dropped. A slow or broken sink therefore never holds up the watcher nor the other sinks.
+
+        Subclasses implement deliver(), raising on failure.
+
+        :param size: int maximum number of lines queued
+        :param batch: int maximum number of lines delivered at once
+        :param retries: int number of times a failed batch is retried
+        :param backoff: float number of seconds before the first retry, doubled on each retry
+        :param ceiling: float maximum number of seconds between two retries
+    """
+
+    name = None
+
+    def __init__(self, size=4096, batch=256, retries=5, backoff=1.0, ceiling=60.0):
+
+        self.queue = Queue(size)
+        self.batch = batch
+        self.retries = retries
+        self.backoff = backoff
+        self.ceiling = ceiling
+
+    def start(self):
+
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def put(self, lines):
+        """
+            Queues lines for delivery, dropping the ones that do not fit.
+            :param lines: list of strings
+        """
+
+        for n, line in enumerate(lines):
+
+            try:
+
+                self.queue.put_nowait(line)
+
+            except Full:
+
+                _dropped.inc(len(lines) - n, sink=self.name, reason='full')
+                return
+
+    def deliver(self, lines):
+        """
+            Delivers a batch of lines, raising on failure.
+            :param lines: list of strings
+        """
+
+        raise NotImplementedError
+
+    def _run(self):
+
+        while True:
+
+            lines = [self.queue.get()]
+
+            try:
+
+                while len(lines) < self.batch:
+                    lines.append(self.queue.get_nowait())
+
+            except Empty:
+
+                pass
+
+            for attempt in range(self.retries + 1):
+
+                try:
+
+                    with _latency.time(sink=self.name):
+
+                        self.deliver(lines)
+
+                    break
+
+                except Exception as e:
+
+                    if attempt == self.retries:
+
+                        logger.warning('Sink %s: dropping %d lines (%s)' % (self.name, len(lines), e))
+                        _dropped.inc(len(lines), sink=self.name, reason='failed')
+                        break
+
+                    pause = min(self.ceiling, self.backoff * 2 ** attempt)
+                    logger.debug('Sink %s: delivery failed (%s), retrying in %.1f seconds' % (self.name, e, pause))
+                    time.sleep(pause)
+
+def _reraise(record):
+
+    #
+    # - logging handlers swallow their errors, raise them instead so that the batch is retried
+    #
+    raise
+
+class File(Sink):
+    """
+        Appends the lines to a file rolled over every spill bytes, e.g for a log forwarder to tail.
+
+        :param path: file to write
+        :param spill: int number of bytes written before the file is rolled over
+        :param backups: int number of rolled over files kept
+    """
+
+    name = 'file'
+
+    def __init__(self, path, spill=1048576, backups=3, **kwargs):
+
+        super(File, self).__init__(**kwargs)
+
+        self.handler = RotatingFileHandler(path, maxBytes=spill, backupCount=backups)
+        self.handler.setFormatter(Formatter('%(message)s'))
+        self.handler.handleError = _reraise
+
+    def deliver(self, lines):
+
+        self.handler.handle(makeLogRecord({'msg': '\n'.join(lines), 'levelno': INFO, 'levelname': 'INFO'}))
+
+class Stdout(Sink):
+    """
+        Writes the lines to stdout, which the pod pipes into its own log.
+    """
+
+    name = 'stdout'
+
+    def deliver(self, lines):
+
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
+class Webhook(Sink):
+    """
+        POSTs each batch to a URL as newline delimited JSON, any status other than 2xx being a failure.
+
+        :param url: URL to POST to
+        :param timeout: float number of seconds allowed for each request
+    """
+
+    name = 'webhook'
+
+    def __init__(self, url, timeout=10.0, **kwargs):
+
+        super(Webhook, self).__init__(**kwargs)
+
+        self.url = url
+        self.timeout = timeout
+        self.session = Session()
+
+    def deliver(self, lines):
+
+        reply = self.session.post(self.url, data='\n'.join(lines) + '\n', headers={'Content-Type': 'application/x-ndjson'}, timeout=self.timeout)
+        assert 200 <= reply.status_code < 300, 'HTTP %d from %s' % (reply.status_code, self.url)
+
+class Syslog(Sink):
+    """
+        Sends each line as a syslog message.
+
+        :param address: either a unix socket path (e.g /dev/log) or a <host>:<port> UDP endpoint
+        :param facility: syslog facility name, e.g 'user' or 'local0'
+    """
+
+    name = 'syslog'
+
+    def __init__(self, address='/dev/log', facility='user', **kwargs):
+
+        super(Syslog, self).__init__(**kwargs)
+
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+            address = (host, int(port))
+
+        self.handler = SysLogHandler(address=address, facility=SysLogHandler.facility_names[facility])
+        self.handler.setFormatter(Formatter('watcher: %(message)s'))
+        self.handler.handleError = _reraise
+
+    def deliver(self, lines):
+
+        for line in lines:
+            self.handler.handle(makeLogRecord({'msg': line, 'levelno': INFO, 'levelname': 'INFO'}))
+
+#
+# - sink name -> class, as listed in ALERTS_SINKS
+#
+SINKS = {sink.name: sink for sink in [File, Stdout, Webhook, Syslog]}
+
+def create(kinds, options, **kwargs):
+    """
+        Starts the sinks listed, leaving out (with a warning) the ones that cannot be set up, e.g a file that cannot be
+        written to.
+
+        :param kinds: list of sink names, e.g ['file', 'webhook']
+        :param options: dict of {sink name: dict of its specific parameters}
+        :param kwargs: queueing & retry parameters common to all the sinks
+    """
+
+    sinks = []
+
+    for kind in kinds:
+
+        assert kind in SINKS, 'unknown alert sink %s (must be one of %s)' % (kind, ', '.join(sorted(SINKS)))
+
+        try:
+
+            sinks.append(SINKS[kind](**dict(kwargs, **options.get(kind, {}))).start())
+
+        except (IOError, OSError) as e:
+
+            logger.warning('Alert sink %s not enabled (%s)' % (kind, e))
+
+    return sinks
@@ -0,0 +1,234 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import socket
+
+from requests import Session
+
+logger = logging.getLogger('ochopod')
+
+#
+# - the HAProxy CSV columns we keep, all of them integers
+# - see section 9.1 of the HAProxy management guide for their meaning
+#
+FIELDS = ('qcur', 'qmax', 'scur', 'smax', 'stot', 'rate', 'req_rate', 'hrsp_5xx', 'qtime', 'ctime', 'rtime', 'ttime')
+
+#
+# - the columns which are averaged timings (in ms) as opposed to totals over the proxy
+#
+TIMERS = ('qtime', 'ctime', 'rtime', 'ttime')
+
+#
+# - the columns counting requests waiting for a server, which tell the proxy is short of servers but not by how many
+#
+QUEUES = ('qcur',)
+
+#
+# - header line -> {column: position} index, built once per distinct header
+#
+_indices = {}
+
+#
+# - keep-alive connections to the stats pages
+#
+_session = Session()
+
+class Record(object):
+    """
+        Compact, typed view of one row of the HAProxy stats (a FRONTEND, a BACKEND or a server). Missing or empty
+        columns are reported as 0.
+    """
+
+    __slots__ = ('proxy', 'name', 'status') + FIELDS
+
+    def __init__(self, proxy, name, status, values):
+
+        self.proxy = proxy
+        self.name = name
+        self.status = status
+
+        for field, value in zip(FIELDS, values):
+            setattr(self, field, value)
+
+    def __repr__(self):
+
+        return '<%s/%s %s>' % (self.proxy, self.name, ' '.join('%s=%d' % (field, getattr(self, field)) for field in FIELDS))
+
+class Stats(object):
+    """
+        Stats parsed out of one HAProxy CSV page, e.g stats.backends['local'].rate or stats.servers['local']['listener-0'].scur.
+    """
+
+    def __init__(self):
+
+        self.frontends = {}
+        self.backends = {}
+        self.servers = {}
+
+    def add(self, record):
+
+        if record.name == 'FRONTEND':
+
+            self.frontends[record.proxy] = record
+
+        elif record.name == 'BACKEND':
+
+            self.backends[record.proxy] = record
+
+        else:
+
+            self.servers.setdefault(record.proxy, {})[record.name] = record
+
+def _index(header):
+
+    if header not in _indices:
+
+        columns = header.lstrip('# ').rstrip(',').split(',')
+        _indices[header] = {column: position for position, column in enumerate(columns)}
+
+    return _indices[header]
+
+def _int(value):
+
+    return int(value) if value else 0
+
+def parse(lines, proxies=None):
+    """
+        Parses HAProxy CSV stats line by line. Rows are split once and only the columns listed in FIELDS are kept.
+
+        :param lines: iterable over the lines of the CSV page, header first
+        :param proxies: optional collection of proxy names to keep, all the others being skipped before being split
+    """
+
+    stats = Stats()
+    lines = iter(lines)
+
+    for header in lines:
+
+        if header:
+            break
+
+    else:
+
+        return stats
+
+    index = _index(header)
+    positions = [index.get(field) for field in FIELDS]
+    status = index.get('status')
+    prefixes = tuple('%s,' % proxy for proxy in proxies) if proxies else None
+
+    for line in lines:
+
+        if not line or (prefixes and not line.startswith(prefixes)):
+
+            continue
+
+        row = line.split(',')
+        values = [_int(row[position]) if position is not None else 0 for position in positions]
+        stats.add(Record(row[0], row[1], row[status] if status is not None else '', values))
+
+    return stats
+
+class Source(object):
+    """
+        Base class for the places HAProxy stats can be read from.
+    """
+
+    def fetch(self, proxies=None):
+        """
+            Reads and parses the stats, returning a Stats object.
+            :param proxies: optional collection of proxy names to keep
+        """
+
+        raise NotImplementedError
+
+class HTTP(Source):
+    """
+        Reads the CSV stats page of a HAProxy (the 'listen stats' section in frontend.cfg), streaming the response.
+
+        :param url: <ip>:<port> for the HAProxy stats page
+        :param auth: optional (user, password) tuple for HTTP basic auth
+        :param timeout: float number of seconds allowed for the request
+    """
+
+    def __init__(self, url, auth=None, timeout=5.0):
+
+        self.url = url
+        self.auth = auth
+        self.timeout = timeout
+
+    def fetch(self, proxies=None):
+
+        reply = _session.get('http://%s/;csv' % self.url, auth=self.auth, timeout=self.timeout, stream=True)
+
+        try:
+
+            code = reply.status_code
+            assert code == 200 or code == 201, 'Polling HAProxy failed (HTTP %d)' % code
+            return parse(reply.iter_lines(), proxies=proxies)
+
+        finally:
+
+            reply.close()
+
+class Socket(Source):
+    """
+        Reads the stats through the HAProxy stats socket ('stats socket' in frontend.cfg) using 'show stat'. This skips
+        HTTP and its authentication altogether and lets HAProxy itself filter what is dumped.
+
+        :param address: <ip>:<port> for a TCP socket or the path to a unix socket
+        :param iid: proxy numeric id to dump, -1 for all of them
+        :param types: bit mask of the rows to dump (1 for frontends, 2 for backends, 4 for servers), -1 for all of them
+        :param timeout: float number of seconds allowed for the exchange
+    """
+
+    def __init__(self, address, iid=-1, types=-1, timeout=5.0):
+
+        self.address = address
+        self.iid = iid
+        self.types = types
+        self.timeout = timeout
+
+    def fetch(self, proxies=None):
+
+        if self.address.startswith('/'):
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+
+        else:
+
+            host, port = self.address.rsplit(':', 1)
+            sock = socket.create_connection((host, int(port)), self.timeout)
+
+        try:
+
+            #
+            # - HAProxy answers a single command then closes the connection
+            #
+            sock.sendall('show stat %d %d -1\n' % (self.iid, self.types))
+            return parse((line.rstrip('\n') for line in sock.makefile('r')), proxies=proxies)
+
+        finally:
+
+            sock.close()
+
+#
+# - the available sources, by name
+#
+SOURCES = {'http': HTTP, 'socket': Socket}
@@ -0,0 +1,622 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+import sys
+import time
+from os import environ
+from ochopod.core.fsm import diagnostic, shutdown
+from ochopod.core.utils import retry, shell
+from alerts import Alerts
+from discovery import Supervisor, Worker, expand
+from events import ZooKeeper
+from metrics import REGISTRY
+from portal import Portal
+from scheduler import Rest, Scheduler, advance
+from sinks import create
+from snapshot import Snapshot
+from tracing import TRACER, install, phase
+from pykka import ThreadingActor, ThreadingFuture, Timeout, ActorRegistry
+from pykka.exceptions import ActorDeadError
+
+logger = logging.getLogger('ochopod')
+
+class Watcher(Worker):
+
+    def __init__(self, remote, scheduler, clusters, alerts=None, period=30.0, wait=10.0, checks=3, timeout=20.0, max_period=None, backoff=2.0):
+
+            super(Watcher, self).__init__(scheduler, clusters) 
+
+            self.remote = remote
+            self.alerts = alerts
+            self.period = period
+            self.max_period = max(max_period or period, period)
+            self.backoff = backoff
+            self.wait = wait
+            self.checks = checks
+            self.timeout = timeout
+
+            #
+            # - per cluster: the pass in progress, the records of previous health checks and its current cadence
+            #
+            self.tasks = {}
+            self.stores = {}
+
+    def on_start(self):
+
+        logger.info('Starting Watcher for %s...' % ', '.join(self.clusters))
+        super(Watcher, self).on_start()
+
+    def tick(self, cluster):
+
+        if cluster not in self.stores:
+            self.stores[cluster] = ({}, {}, {})
+
+        store_indeces, store_health, cadence = self.stores[cluster]
+
+        #
+        # - run the cluster's pass up to its next pause and have the scheduler wake us up once it is over
+        #
+        try:
+
+            self.tasks[cluster], delay = advance(self.tasks.get(cluster), lambda: _watch(self.remote,
+                                                                                         cluster=cluster,
+                                                                                         alerts=self.alerts,
+                                                                                         period=self.period,
+                                                                                         wait=self.wait,
+                                                                                         checks=self.checks,
+                                                                                         timeout=self.timeout,
+                                                                                         store_indeces=store_indeces,
+                                                                                         store_health=store_health,
+                                                                                         cadence=cadence,
+                                                                                         max_period=self.max_period,
+                                                                                         backoff=self.backoff), self.period)
+
+        except Exception as e:
+
+            logger.warning('Watcher actor for %s exception: %s' % (cluster, e))
+            self.tasks[cluster], delay = None, self.period
+
+        return delay
+
+    def forget(self, cluster):
+
+        self.tasks.pop(cluster, None)
+        self.stores.pop(cluster, None)
+
+        if self.alerts:
+            self.alerts.forget(cluster)
+
+    def on_stop(self):
+
+        logger.info('Stopping Watcher actor for %s' % ', '.join(self.clusters))
+
+class Record(object):
+    """
+        Compact state of one namespace/cluster as seen by one check: its pod indeces, how many pods are up (running)
+        or down and the status of the latter, keyed like the portal output.
+    """
+
+    __slots__ = ('indeces', 'up', 'down', 'diagnostic')
+
+    def __init__(self):
+
+        self.indeces = set()
+        self.up = 0
+        self.down = 0
+        self.diagnostic = {}
+
+def _parse(data, allowed):
+    """
+        Helper turning a grep output into one Record per namespace/cluster, splitting each key once.
+        :param data: dict keyed by '<namespace>.<cluster> #<index>' as returned by the portal
+        :param allowed: list of the sub-process states counting as up
+    """
+
+    records = {}
+
+    for key, status in data.iteritems():
+
+        #
+        # - split on the last ' #' in case the user has used ' #' in the namespace
+        #
+        name, _, index = key.rpartition(' #')
+        record = records.get(name)
+
+        if record is None:
+            record = records[name] = Record()
+
+        record.indeces.add(int(index))
+
+        if status['process'] in allowed:
+
+            record.up += 1
+
+        else:
+
+            record.down += 1
+            record.diagnostic[key] = status
+
+    return records
+
+def _watch(remote, cluster='*', alerts=None, period=30.0, wait=10.0, checks=3, timeout=20.0, store_indeces={}, store_health={}, cadence={}, max_period=None, backoff=2.0):
+    """
+        Watches a list of clusters for failures in health checks (defined as non-running process status). This fires a number of checks
+        every period with a wait between each check. E.g. it can check 3 times every 5-minute period with a 10 second wait between checks.
+
+        The cadence adapts to the clusters: checks only go on while some pods are down, i.e until the clusters recover or
+        run out of checks, healthy ones being checked once per pass. Passes where all the clusters stayed stable are
+        spaced further and further apart (the pause growing by backoff each time, up to max_period), any activity or
+        failure bringing it back to period.
+
+        This is a generator yielding the number of seconds to pause for (see scheduler.py), its actor being told to resume it
+        once they have elapsed. The records of previous health checks are updated in place.
+
+        :param cluster: glob patterns matching clusters to be watched
+        :param alerts: Alerts stream the events are emitted to, None to just log them
+        :param period: float amount of seconds in each polling period
+        :param wait: float amount of seconds between each check
+        :param checks: int number of failed checks allowed before an alert is sent
+        :param timeout: float number of seconds allowed for querying ochopod  
+        :param store_indeces: dict of {name: set of indeces} seen during the previous checks
+        :param store_health: dict of {name: health record} built during the previous checks
+        :param cadence: dict holding the pause after the previous pass, updated in place
+        :param max_period: float maximum amount of seconds between two passes of stable clusters, at least period
+        :param backoff: float factor the pause grows by after each stable pass
+    """
+
+    assert period > checks*wait, "A period of %d seconds doesn't allow for %d x %d second polling repetitions." % (period, checks, wait)
+
+    print 'Polling cluster %s...' % cluster
+
+    #
+    # - Allowed states for subprocess to be in
+    #
+    allowed = ['running']
+
+    #
+    # - Records of previous health checks
+    #
+    store_indeces = store_indeces
+    store_health = store_health
+
+    #
+    # - Emit each event on its own, e.g emit('marathon.web', 'indeces_lost', indeces=[3, 4])
+    # - events are held while analysing & deciding and emitted at once (see flush below) to trace their own phase
+    #
+    sink = alerts.emit if alerts else lambda name, event, **fields: logger.info(json.dumps(dict(fields, cluster=name, event=event)))
+    pending = []
+    emit = lambda name, event, **fields: pending.append((name, event, fields))
+
+    def flush():
+
+        phase('act')
+
+        for name, event, fields in pending:
+            sink(name, event, **fields)
+
+        del pending[:]
+
+    #
+    # - Whether all the clusters stayed stable during this pass & number of seconds spent waiting between checks
+    #
+    calm = True
+    waited = 0
+
+    #
+    # - Poll clusters every period and log consecutive health check failures, up to the allowed number of heath checks
+    #
+    for i in range(checks + 1):
+
+        #
+        # - Poll health of pod's subprocess
+        #
+        phase('fetch')
+        js = remote('grep %s -j' % cluster)
+
+        if not js['ok']:
+
+            logger.warning('Watcher: communication with portal during metrics collection failed.')
+            calm = False
+            continue
+
+        phase('parse')
+        data = json.loads(js['out'])
+
+        if len(data) == 0:
+
+            logger.warning('Watcher: did not find any pods under %s.' % cluster)
+            calm = False
+            continue
+
+        #
+        # - Current state of each namespace/cluster, built in a single pass over the pods
+        #
+        records = _parse(data, allowed)
+
+        # ---------------------
+        # - Analyse pod indeces
+        # ---------------------
+        phase('analyse')
+
+        for name, record in records.iteritems():
+
+            indeces = record.indeces
+
+            #
+            # - First time cluster has been observed
+            #
+            if not name in store_indeces:
+
+                store_indeces[name] = indeces
+                continue
+
+            previous = store_indeces[name]
+
+            #
+            # - Nothing to compare if the indeces did not change since the previous check
+            #
+            if previous == indeces:
+
+                continue
+
+            #
+            # - The base index has changed (not supposed to happen even when scaling to an instance # above 0)
+            # - warn anyway if indeces have jumped even if health is fine
+            #
+            base_index = min(previous)
+
+            if base_index not in indeces:
+
+                emit(name, 'index_changed_base', previous=base_index, current=min(indeces))
+
+            #
+            # - Some previously-stored indeces have disappeared if delta is not None
+            #
+            delta = previous - indeces
+            
+            if delta:
+
+                emit(name, 'indeces_lost', indeces=sorted(delta))
+
+            #
+            # Update the stored indeces with current set
+            #
+            store_indeces[name] = indeces
+
+        # --------------------
+        # - Analyse pod health
+        # --------------------
+        for name, record in records.iteritems():
+
+            #
+            # - First time cluster has been observed
+            #
+            if not name in store_health:
+
+                store_health[name] = {
+                    'remaining': checks, 
+                    'ochopod_cluster_activity': 'active',
+                    'report_next_failure': True,
+                    'report_recovery': False
+                }
+
+            #
+            # - Cluster healthy and stable
+            #
+            elif record.down == 0 and record.up == store_health[name]['ochopod_cluster_up']:
+
+                store_health[name].update({
+                    'ochopod_cluster_activity': 'stable',
+                })
+
+            #
+            # - Cluster healthy but health/count has changed (active)
+            #
+            elif record.down == 0:
+                
+                #
+                # - Reset remaining checks
+                #
+                store_health[name].update({
+                    'remaining': checks,
+                    'ochopod_cluster_activity': 'active',
+                })
+
+            #
+            # - Cluster unhealthy but active
+            #
+            elif record.up != store_health[name]['ochopod_cluster_up'] or record.down != store_health[name]['ochopod_cluster_down']:
+
+                store_health[name].update({
+                    'ochopod_cluster_activity': 'fluctuating',
+                })
+
+            #
+            # - Cluster unhealthy and stagnant
+            #
+            else:
+
+                store_health[name]['remaining'] -= 1
+                store_health[name]['ochopod_cluster_activity'] = 'stagnant'
+
+            #
+            # - Update all other parameters
+            #
+            store_health[name].update({
+                'ochopod_cluster_down': record.down,
+                'ochopod_cluster_up': record.up,
+                'ochopod_diagnostic': record.diagnostic
+            })
+
+        # -----------------------------------------------
+        # - Check if any cluster has disappeared entirely
+        # -----------------------------------------------
+        for name in [name for name in store_health if name not in records]:
+
+            emit(name, 'cluster_lost', indeces=sorted(store_indeces[name]), ochopod_cluster_activity='absent',
+                 ochopod_cluster_up=0, ochopod_cluster_down=0, ochopod_diagnostic='lost cluster')
+
+            del store_health[name]
+            del store_indeces[name]
+            calm = False
+
+        #
+        # - A cluster is settled when stable, or when stagnant with its failure already reported (nothing new to tell
+        # - until its state changes)
+        #
+        settled = lambda name: store_health[name]['ochopod_cluster_activity'] == 'stable' or \
+            (store_health[name]['ochopod_cluster_activity'] == 'stagnant' and not store_health[name]['report_next_failure'])
+
+        calm = calm and all(settled(name) for name in records)
+        flush()
+
+        #
+        # - Only re-check (at a fast cadence) while some pods are down, until they recover or run out of checks
+        # - clusters whose failure was reported are not re-checked until their state changes
+        #
+        if i == checks or not any(record.down and not settled(name) for name, record in records.iteritems()):
+            break
+
+        waited += wait
+        yield wait
+
+    #
+    # - Check allowance exceeded for each cluster's health; emit an alert if
+    # - all health checks had failed
+    # - Do this whole loop once per _watch() call
+    #
+    phase('decide')
+
+    for name, health in store_health.iteritems():
+
+        #
+        # - Cluster is unhealthy and stagnant; report just once
+        #
+        if 'remaining' in health and not health['remaining'] > 0 and health['ochopod_cluster_activity'] == 'stagnant' and health['report_next_failure']:
+
+            emit(name, 'health', **{key: item for key, item in health.iteritems()
+                if key not in ['report_next_failure', 'report_recovery', 'remaining']})
+
+            health.update({
+                'report_next_failure': False,
+                'report_recovery': True
+            })
+
+        #
+        # - Cluster is unhealthy and fluctuating; keep reporting until stagnation/recovery
+        #
+        elif health['ochopod_cluster_activity'] == 'fluctuating' and health['report_next_failure']:
+
+            emit(name, 'health', **{key: item for key, item in health.iteritems()
+                if key not in ['report_next_failure', 'report_recovery', 'remaining']})
+
+            health.update({
+                'report_next_failure': True,
+                'report_recovery': True
+            })
+
+        #
+        # - Cluster was unhealthy but has recovered; report just once
+        #
+        elif health['ochopod_cluster_activity'] in ['active', 'stable'] and health['report_recovery']:
+
+            emit(name, 'health', **{key: item for key, item in health.iteritems()
+                if key not in ['report_next_failure', 'report_recovery', 'remaining', 'ochopod_diagnostic']})
+
+            health.update({
+                'report_next_failure': True,
+                'report_recovery': False
+            })        
+
+        #
+        # - Reset checks count for next period
+        #
+        store_health[name]['remaining'] = checks
+
+    flush()
+
+    #
+    # - Back off while the clusters stay stable, any activity or failure restoring the regular period
+    #
+    cadence['pause'] = min(max(max_period or period, period), cadence.get('pause', period) * backoff) if calm else period
+
+    yield Rest(max(0, cadence['pause'] - waited))
+
+if __name__ == '__main__':
+
+    refs = []
+    scheduler = None
+    events = None
+
+    try:
+
+        #
+        # - parse our ochopod hints
+        # - enable CLI logging
+        # - pass down the ZK ensemble coordinate
+        #
+        env = environ
+        hints = json.loads(env['ochopod'])
+        env['OCHOPOD_ZK'] = hints['zk']
+
+        #
+        # - Check for passed set of clusters to be watched in deployment yaml
+        #
+        watching = env['DAYCARE'].split(',') if 'DAYCARE' in env else ['*'] 
+        period = float(env['PERIOD']) if 'PERIOD' in env else 60
+
+        #
+        # - Number of actors (and thus threads) the clusters are spread over
+        #
+        workers = int(env['WORKERS']) if 'WORKERS' in env else 4
+        assert workers > 0, 'WORKERS must be at least 1'
+
+        #
+        # - Get the portal that we found during cluster configuration (see pod/pod.py)
+        #
+        _, lines = shell('cat /opt/watcher/.portal')
+        portal = lines[0]
+        assert portal, '/opt/watcher/.portal not found (pod not yet configured ?)'
+        logger.debug('using proxy @ %s' % portal)
+        
+        #
+        # - load our logging configuration from config/log.cfg
+        # - make sure to not reset existing loggers
+        #
+        from logging.config import fileConfig
+        fileConfig('/opt/watcher/config/log.cfg', disable_existing_loggers=False)
+
+        #
+        # - Deliver the alerts to each of the ALERTS_SINKS (file, stdout, webhook and/or syslog)
+        # - the file is /var/log/watcher.log, rolled over every ALERTS_SPILL bytes: it is retrieved via /log requests
+        # - and tailed by the Splunk forwarder, if any (see pod/pod.py)
+        # - each sink queues up to ALERTS_SINK_QUEUE lines of its own and retries failed batches with a backoff
+        #
+        options = \
+            {
+                'file': {'path': '/var/log/watcher.log', 'spill': int(env['ALERTS_SPILL']) if 'ALERTS_SPILL' in env else 1048576},
+                'webhook': {'url': env['ALERTS_WEBHOOK'] if 'ALERTS_WEBHOOK' in env else None},
+                'syslog': {'address': env['ALERTS_SYSLOG'] if 'ALERTS_SYSLOG' in env else '/dev/log'}
+            }
+
+        kinds = env['ALERTS_SINKS'].split(',') if 'ALERTS_SINKS' in env else ['file', 'stdout']
+        assert 'webhook' not in kinds or options['webhook']['url'], 'ALERTS_WEBHOOK must be set to use the webhook sink'
+        sinks = create(kinds, options, size=int(env['ALERTS_SINK_QUEUE']) if 'ALERTS_SINK_QUEUE' in env else 4096)
+
+        #
+        # - Stream the alerts to the sinks, one compact line per event
+        # - at most ALERTS_RATE events per cluster every ALERTS_WINDOW seconds, repeats within the window being dropped
+        # - at most ALERTS_QUEUE events waiting to be handed over, in batches of up to ALERTS_BATCH lines
+        #
+        alerts = Alerts(sinks,
+                        size=int(env['ALERTS_QUEUE']) if 'ALERTS_QUEUE' in env else 1024,
+                        batch=int(env['ALERTS_BATCH']) if 'ALERTS_BATCH' in env else 64,
+                        rate=int(env['ALERTS_RATE']) if 'ALERTS_RATE' in env else 10,
+                        window=float(env['ALERTS_WINDOW']) if 'ALERTS_WINDOW' in env else 60.0).start()
+
+        #
+        # - Remote for direct communication with the portal
+        # - the connections are pooled and shared by all the actors
+        # - greps are answered from one shared snapshot of the portal, refreshed at most every SNAPSHOT_TTL seconds
+        #
+        remote = Snapshot(Portal(portal,
+                                 timeout=float(env['PORTAL_TIMEOUT']) if 'PORTAL_TIMEOUT' in env else 20.0,
+                                 retries=int(env['PORTAL_RETRIES']) if 'PORTAL_RETRIES' in env else 2),
+                          ttl=float(env['SNAPSHOT_TTL']) if 'SNAPSHOT_TTL' in env else 5.0)
+        
+        #
+        # - Optionally have ZooKeeper tell us as soon as pods change (EVENTS=zk): clusters are then checked right away
+        # - instead of at their next period, polling only reconciling every RECONCILE_PERIOD seconds
+        #
+        mode = env['EVENTS'] if 'EVENTS' in env else 'poll'
+        assert mode in ['poll', 'zk'], 'EVENTS must be either poll or zk'
+
+        if mode == 'zk':
+
+            events = ZooKeeper(env['OCHOPOD_ZK'], snapshot=remote)
+            events.start()
+            period = float(env['RECONCILE_PERIOD']) if 'RECONCILE_PERIOD' in env else 300.0
+
+        #
+        # - Keep the last TRACE_SIZE ticks along with the time spent in each of their phases, written to TRACE_DUMP on
+        # - SIGUSR1 (or fetched from /trace on METRICS_PORT)
+        # - optionally profile one tick out of every PROFILE_EVERY, the cProfile stats being written to PROFILE_DIR
+        #
+        TRACER.configure(size=int(env['TRACE_SIZE']) if 'TRACE_SIZE' in env else 256,
+                         every=int(env['PROFILE_EVERY']) if 'PROFILE_EVERY' in env else 0,
+                         directory=env['PROFILE_DIR'] if 'PROFILE_DIR' in env else '/tmp')
+
+        install(env['TRACE_DUMP'] if 'TRACE_DUMP' in env else '/tmp/watcher-trace.json')
+
+        #
+        # - Initialise the supervisor and start
+        # - it expands our glob patterns every DISCOVERY_PERIOD seconds and spreads the clusters found over a fixed
+        # - number of watcher actors, starting & stopping them as clusters come and go
+        # - each actor is woken up by the scheduler whenever one of its clusters is due instead of sleeping between checks
+        #
+        scheduler = Scheduler()
+        discovery = float(env['DISCOVERY_PERIOD']) if 'DISCOVERY_PERIOD' in env else 60.0
+        #
+        # - Clusters staying stable are checked less and less often, up to every MAX_PERIOD seconds (set it to PERIOD to
+        # - always check every period), which defaults to 4 times the period in use and is never less than it
+        #
+        max_period = float(env['MAX_PERIOD']) if 'MAX_PERIOD' in env else 4 * period
+        spawn = lambda group: Watcher.start(remote, scheduler, group, alerts=alerts, period=period, max_period=max_period)
+        refs = [Supervisor.start(scheduler, lambda: expand(remote, watching), spawn, period=discovery, workers=workers, events=events, globs=watching, name='watcher')]
+
+        #
+        # - Serve our metrics (portal latencies, ticks, reports...) over HTTP on METRICS_PORT, 0 to disable
+        #
+        port = int(env['METRICS_PORT']) if 'METRICS_PORT' in env else 9100
+
+        if port:
+            REGISTRY.serve(port, routes={'/trace': lambda: ('application/json', json.dumps(TRACER.dump()))})
+
+        #
+        # - Stay around to handle signals (only the main thread does), the actors running on their own threads
+        #
+        while all(ref.is_alive() for ref in refs):
+
+            time.sleep(1.0)
+
+    except Exception as failure:
+
+        logger.fatal('Error on line %s' % (sys.exc_info()[-1].tb_lineno))
+        logger.fatal('unexpected condition -> %s' % failure)
+
+    finally:
+
+        if scheduler:
+
+            scheduler.stop()
+
+        if events:
+
+            events.stop()
+
+        for ref in refs:
+
+            try:
+
+                ref.stop()
+
+            except Exception as e:
+
+                pass
+
+        sys.exit(1)
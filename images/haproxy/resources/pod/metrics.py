@@ -0,0 +1,286 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import time
+
+from bisect import bisect_left
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+
+logger = logging.getLogger('ochopod')
+
+#
+# - default histogram buckets, in seconds
+#
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format(value):
+
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(object):
+    """
+        Base class for the metrics, each holding one value (or set of values) per combination of its labels.
+
+        :param name: metric name, e.g 'portal_request_seconds'
+        :param description: one line help text
+        :param labels: list of label names
+    """
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        self.values = {}
+
+    def _key(self, labels):
+
+        assert set(labels) == set(self.labels), '%s expects labels %s' % (self.name, ', '.join(self.labels))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _labels(self, key, extra=()):
+
+        pairs = zip(self.labels, key) + list(extra)
+        return '{%s}' % ','.join('%s="%s"' % (label, _escape(value)) for label, value in pairs) if pairs else ''
+
+    def lines(self):
+        """
+            Returns the metric in text exposition format, as a list of lines.
+        """
+
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s %s' % (self.name, self.kind)]
+
+        with self.lock:
+
+            for key, value in sorted(self.values.iteritems()):
+                lines += self._samples(key, value)
+
+        return lines
+
+    def _samples(self, key, value):
+
+        return ['%s%s %s' % (self.name, self._labels(key), _format(value))]
+
+class Counter(Metric):
+    """
+        Monotonic counter, e.g counter.inc(command='kill').
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+
+        key = self._key(labels)
+
+        with self.lock:
+
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+        Value going up & down, e.g gauge.set(12, loop='watcher').
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+
+        key = self._key(labels)
+
+        with self.lock:
+
+            self.values[key] = value
+
+class Histogram(Metric):
+    """
+        Distribution of observed values (typically latencies in seconds) over fixed buckets, e.g::
+
+            with histogram.time(command='grep'):
+                ...
+
+        :param buckets: sorted upper bounds of the buckets, +Inf being implied
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+
+        super(Histogram, self).__init__(name, description, labels)
+
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+
+        key = self._key(labels)
+
+        with self.lock:
+
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+
+            counts, _, _ = entry = self.values[key]
+            index = bisect_left(self.buckets, value)
+
+            if index < len(counts):
+                counts[index] += 1
+
+            entry[1] += 1
+            entry[2] += value
+
+    def time(self, **labels):
+        """
+            Returns a context manager observing how long its block took.
+        """
+
+        return _Timer(self, labels)
+
+    def _samples(self, key, value):
+
+        counts, total, seconds = value
+        lines = []
+        cumulated = 0
+
+        for bound, count in zip(self.buckets, counts):
+
+            cumulated += count
+            lines.append('%s_bucket%s %d' % (self.name, self._labels(key, [('le', _format(bound))]), cumulated))
+
+        lines.append('%s_bucket%s %d' % (self.name, self._labels(key, [('le', '+Inf')]), total))
+        lines.append('%s_sum%s %s' % (self.name, self._labels(key), _format(seconds)))
+        lines.append('%s_count%s %d' % (self.name, self._labels(key), total))
+        return lines
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *_):
+
+        self.histogram.observe(time.time() - self.started, **self.labels)
+
+class Registry(object):
+    """
+        In-process metrics registry. Metrics are declared once (declaring one again returns the existing one) and the
+        whole registry is rendered in the Prometheus text exposition format, optionally over HTTP.
+    """
+
+    def __init__(self):
+
+        self.lock = Lock()
+        self.metrics = {}
+
+    def counter(self, name, description, labels=()):
+
+        return self._declare(Counter, name, description, labels)
+
+    def gauge(self, name, description, labels=()):
+
+        return self._declare(Gauge, name, description, labels)
+
+    def histogram(self, name, description, labels=(), buckets=BUCKETS):
+
+        return self._declare(Histogram, name, description, labels, buckets=buckets)
+
+    def _declare(self, kind, name, description, labels, **kwargs):
+
+        with self.lock:
+
+            if name not in self.metrics:
+                self.metrics[name] = kind(name, description, labels, **kwargs)
+
+            metric = self.metrics[name]
+            assert isinstance(metric, kind), 'metric %s is already declared as a %s' % (name, metric.kind)
+            return metric
+
+    def expose(self):
+        """
+            Returns the registry in text exposition format.
+        """
+
+        with self.lock:
+
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+
+        return '\n'.join(line for metric in metrics for line in metric.lines()) + '\n'
+
+    def serve(self, port, routes=None):
+        """
+            Serves the registry over HTTP on /metrics from a background thread.
+            :param port: int TCP port to listen on
+            :param routes: optional dict of extra paths, each mapped to a function returning (content type, body)
+        """
+
+        table = {'/metrics': lambda: ('text/plain; version=0.0.4', self.expose())}
+        table.update(routes or {})
+
+        class _Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+
+                route = table.get(self.path.split('?')[0])
+
+                if not route:
+
+                    self.send_error(404)
+                    return
+
+                kind, body = route()
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+
+                pass
+
+        class _Server(ThreadingMixIn, HTTPServer):
+
+            daemon_threads = True
+
+        server = _Server(('', port), _Handler)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logger.info('Metrics: serving on TCP %d' % port)
+        return server
+
+#
+# - the registry shared by everything running in the daemon
+#
+REGISTRY = Registry()
@@ -14,11 +14,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import hashlib
 import json
 import logging
 import os
+import signal
+import socket
+import time
 
+from threading import Condition, RLock, Thread
 from jinja2 import Environment, FileSystemLoader
+from metrics import REGISTRY
 from ochopod.bindings.ec2.marathon import Pod
 from ochopod.models.piped import Actor as Piped
 from ochopod.models.reactive import Actor as Reactive
@@ -26,6 +32,63 @@ from os.path import join, dirname
 
 logger = logging.getLogger('ochopod')
 
+#
+# - admin level stats socket (see frontend.cfg) used to drive the proxy at runtime
+# - pid file holding the haproxy master process pid
+#
+RUNTIME = '/var/run/haproxy.sock'
+PIDFILE = '/var/run/haproxy.pid'
+
+#
+# - our jinja environment & the templates compiled so far, by name
+# - the md5 digest of each configuration file we wrote, by path
+#
+_env = Environment(loader=FileSystemLoader(join(dirname(__file__), 'templates')))
+_templates = {}
+_digests = {}
+
+_reloads = REGISTRY.histogram('haproxy_reload_seconds', 'Time taken by the proxy reloads, until a new worker answers.')
+_unconfirmed = REGISTRY.counter('haproxy_reloads_unconfirmed_total', 'Proxy reloads no new worker answered after in time.')
+
+
+def _render(name, mappings):
+    """
+        Renders one of our templates, compiling it only once.
+    """
+
+    if name not in _templates:
+        _templates[name] = _env.get_template(name)
+
+    return _templates[name].render(mappings)
+
+
+def _write(path, content):
+    """
+        Writes a configuration file unless it already holds that exact content. Returns True if the file was written.
+    """
+
+    digest = hashlib.md5(content.encode('utf-8')).hexdigest()
+
+    if path not in _digests:
+
+        try:
+
+            with open(path, 'rb') as f:
+                _digests[path] = hashlib.md5(f.read()).hexdigest()
+
+        except IOError:
+
+            pass
+
+    if _digests.get(path) == digest:
+        return False
+
+    with open(path, 'wb') as f:
+        f.write(content.encode('utf-8'))
+
+    _digests[path] = digest
+    return True
+
 
 if __name__ == '__main__':
 
@@ -36,6 +99,25 @@ if __name__ == '__main__':
     #
     cfg = json.loads(os.environ['pod'])
 
+    #
+    # - number of server slots pre-allocated in the 'local' backend
+    # - if set the listeners are updated through the runtime API instead of restarting the proxy
+    #
+    slots = int(cfg['slots']) if 'slots' in cfg else 0
+
+    #
+    # - listener changes arriving within debounce seconds of each other are coalesced into one update
+    # - a pending update is never held back more than max_delay seconds
+    #
+    debounce = float(cfg['debounce']) if 'debounce' in cfg else 0.0
+    max_delay = float(cfg['max_delay']) if 'max_delay' in cfg else 30.0
+
+    #
+    # - the TCP stats socket (9003) has no authentication, unlike the stats page: it is only bound to the pod's
+    # - internal address (or to stats_address if set), never to every interface
+    #
+    stats_address = cfg['stats_address'] if 'stats_address' in cfg else socket.gethostbyname(socket.gethostname())
+
     class Model(Reactive):
 
         depends_on = [cfg['target']]
@@ -45,6 +127,34 @@ if __name__ == '__main__':
         cwd = '/opt/haproxy'
         pipe_subprocess = True
 
+        #
+        # - the proxy is never restarted upon re-configuration: it is either updated at runtime (slot mode)
+        # - or reloaded by its master process, the listening sockets being handed over to the new workers
+        #
+        soft = True
+
+        #
+        # - slot index -> downstream url currently set in the 'local' backend
+        #
+        assigned = {}
+        capacity = slots
+
+        def initialize(self):
+
+            #
+            # - latest listeners waiting to be applied & when the first and last of the coalesced changes came in
+            #
+            self.lock = RLock()
+            self.cond = Condition()
+            self.pending = None
+            self.first = self.last = 0
+
+            if debounce:
+
+                thread = Thread(target=self._coalesce)
+                thread.daemon = True
+                thread.start()
+
         def can_configure(self, cluster):
 
             #
@@ -63,32 +173,298 @@ if __name__ == '__main__':
 
             #
             # - grep our listeners
-            # - render into our 'local' backend directive (which is a standalone file)
             #
             urls = cluster.grep(cfg['target'], cfg['port']).split(',')
-            env = Environment(loader=FileSystemLoader(join(dirname(__file__), 'templates')))
             logger.info('%d downstream urls ->\n - %s' % (len(urls), '\n - '.join(urls)))
+
+            running = self._running()
+
+            if debounce and running:
+
+                #
+                # - the proxy is up: defer the update and let _coalesce() batch it with whatever follows
+                #
+                with self.cond:
+
+                    now = time.time()
+                    self.first = now if self.pending is None else self.first
+                    self.last = now
+                    self.pending = urls
+                    self.cond.notify()
+
+            else:
+
+                #
+                # - apply right away, superseding anything still pending
+                #
+                with self.lock:
+
+                    with self.cond:
+                        self.pending = None
+
+                    self._update(urls, running)
+
+            #
+            # - at this point we have both the global/frontend and our default backend
+            # - start haproxy using both configuration files in master-worker mode
+            # - -x fetches the listening sockets from the previous workers upon a reload
+            # - the stats socket address is passed down in $STATS_ADDRESS (see frontend.cfg)
+            #
+            return '/usr/sbin/haproxy -W -f frontend.cfg -f local.cfg -p %s -x %s' % (PIDFILE, RUNTIME), {'STATS_ADDRESS': stats_address}
+
+        def _update(self, urls, running):
+
+            with self.lock:
+
+                #
+                # - slot mode: if the proxy is up and the listeners fit in the slots we have, update them
+                # - at runtime and leave the process alone
+                # - otherwise (or if not in slot mode) grow the slots, render into our 'local' backend directive
+                # - (which is a standalone file) and have the master reload its workers
+                #
+                assigned = self._assign(urls, self.capacity) if slots else {index: endpoint for index, endpoint in enumerate(urls)}
+
+                if slots and running and assigned is not None and self._apply(assigned):
+
+                    #
+                    # - keep local.cfg in sync with what the proxy runs in case it gets reloaded later on
+                    #
+                    self._local(assigned)
+                    logger.info('listeners updated at runtime (%d/%d slots used)' % (len(assigned), self.capacity))
+
+                else:
+
+                    if assigned is None:
+
+                        self.capacity = max(2 * self.capacity, len(urls))
+                        assigned = self._assign(urls, self.capacity)
+                        logger.info('out of slots, growing to %d' % self.capacity)
+
+                    #
+                    # - if the rendered configuration is unchanged (e.g the churn was in some unrelated cluster)
+                    # - there is nothing to reload
+                    #
+                    if self._local(assigned) and running:
+
+                        self._reload(running)
+
+                    elif running:
+
+                        logger.info('local.cfg unchanged, skipping reload')
+
+                self.assigned = assigned
+
+        def _coalesce(self):
+
+            while True:
+
+                with self.cond:
+
+                    #
+                    # - wait for some listeners to apply, then until no change came in for debounce seconds
+                    # - or max_delay seconds went by since the first one
+                    #
+                    while self.pending is None:
+                        self.cond.wait()
+
+                    due = min(self.last + debounce, self.first + max_delay)
+
+                    if time.time() < due:
+
+                        self.cond.wait(due - time.time())
+                        continue
+
+                with self.lock:
+
+                    #
+                    # - configure() may have applied (and cleared) the pending listeners meanwhile
+                    #
+                    with self.cond:
+
+                        urls = self.pending
+                        self.pending = None
+
+                    if urls is None:
+                        continue
+
+                    logger.info('applying %d downstream urls (coalesced over %.1f seconds)' % (len(urls), time.time() - self.first))
+
+                    try:
+
+                        self._update(urls, self._running())
+
+                    except Exception as failure:
+
+                        logger.warning('unable to apply the downstream urls -> %s' % failure)
+
+        def _local(self, assigned):
+
+            #
+            # - render the listeners into local.cfg, padding with disabled spare slots up to our capacity
+            # - returns True if local.cfg changed
+            #
             mappings = \
                 {
-                    'listeners': {'listener-%d' % index: endpoint for index, endpoint in enumerate(urls)}
+                    'listeners': {'listener-%d' % index: endpoint for index, endpoint in assigned.items()},
+                    'spares': ['listener-%d' % index for index in range(self.capacity) if index not in assigned]
                 }
 
-            template = env.get_template('local.cfg')
-            with open('%s/local.cfg' % self.cwd, 'w') as f:
-                f.write(template.render(mappings))
+            return _write('%s/local.cfg' % self.cwd, _render('local.cfg', mappings))
+
+        def _assign(self, urls, capacity):
 
             #
-            # - at this point we have both the global/frontend and our default backend
-            # - start haproxy using both configuration files
+            # - keep the listeners that are still there in their slot and place the new ones in the free slots
+            # - returns None if they do not fit
+            #
+            kept = {index: endpoint for index, endpoint in self.assigned.items() if endpoint in urls and index < capacity}
+            free = [index for index in range(capacity) if index not in kept]
+            new = [endpoint for endpoint in urls if endpoint not in kept.values()]
+
+            if len(new) > len(free):
+                return None
+
+            kept.update(zip(free, new))
+            return kept
+
+        def _apply(self, assigned):
+
+            #
+            # - diff against what the proxy currently has and issue the runtime commands
+            # - a slot whose url changes is disabled first, re-addressed and then enabled
+            #
+            commands = []
+
+            for index in range(self.capacity):
+
+                server = 'local/listener-%d' % index
+                before = self.assigned.get(index)
+                after = assigned.get(index)
+
+                if before == after:
+                    continue
+
+                commands.append('disable server %s' % server)
+
+                if after:
+
+                    ip, port = after.rsplit(':', 1)
+                    commands += ['set server %s addr %s port %s' % (server, ip, port), 'enable server %s' % server]
+
+            if not commands:
+                return True
+
+            out = self._runtime(commands)
+
+            if out:
+
+                logger.warning('runtime update failed -> %s' % out)
+                return False
+
+            return True
+
+        def _runtime(self, commands):
+
             #
-            return '/usr/sbin/haproxy -f frontend.cfg -f local.cfg', {}
+            # - send the commands one at a time over the admin socket and check each reply
+            # - disable/enable stay silent on success while 'set server addr' reports what it did, e.g "IP changed from
+            #   'a' to 'b', port changed from 'c' to 'd' by 'stats socket command'" (or that there was no need to)
+            # - anything else written back is an error, the remaining commands are then not sent
+            # - returns the error, or an empty string if all the commands went through
+            #
+            for command in commands:
+
+                try:
+
+                    out = self._query(command)
+
+                except socket.error as failure:
+
+                    return 'unable to reach %s (%s)' % (RUNTIME, failure)
+
+                if out and not any(notice in out for notice in ['changed from', 'no need to change']):
+                    return '%s -> %s' % (command, out)
+
+            return ''
+
+        def _query(self, command):
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(5.0)
+            sock.connect(RUNTIME)
+
+            try:
+
+                sock.sendall('%s\n' % command)
+                return ''.join(iter(lambda: sock.recv(4096), '')).strip()
+
+            finally:
+
+                sock.close()
+
+        def _worker(self):
+
+            #
+            # - returns the pid of the worker currently answering on the admin socket, 0 if none
+            #
+            try:
+
+                info = dict(line.split(': ', 1) for line in self._query('show info').splitlines() if ': ' in line)
+                return int(info['Pid'])
+
+            except (socket.error, KeyError, ValueError):
+
+                return 0
+
+        def _reload(self, pid, timeout=10.0):
+
+            #
+            # - SIGUSR2 has the master re-read the configuration and spawn new workers (-sf on the old ones)
+            # - the old workers hand their listening sockets over (-x) and finish their in-flight connections
+            # - time the reload until a new worker answers on the admin socket
+            #
+            before = self._worker()
+            now = time.time()
+            os.kill(pid, signal.SIGUSR2)
+
+            while time.time() - now < timeout:
+
+                time.sleep(0.1)
+                worker = self._worker()
+
+                if worker and worker != before:
+
+                    elapsed = time.time() - now
+                    _reloads.observe(elapsed)
+                    logger.info('haproxy reloaded in %.2f seconds (master pid %d, worker pid %d -> %d)' % (elapsed, pid, before, worker))
+                    return
+
+            _unconfirmed.inc()
+            logger.warning('haproxy reload not confirmed after %.2f seconds (master pid %d)' % (timeout, pid))
+
+        def _running(self):
+
+            #
+            # - returns the pid of the haproxy master process if it is alive, 0 otherwise
+            #
+            try:
+
+                with open(PIDFILE, 'r') as f:
+                    pid = int(f.read().split()[0])
+
+                os.kill(pid, 0)
+                return pid
+
+            except (IOError, OSError, ValueError, IndexError):
+
+                return 0
 
         def signaled(self, js, process=None):
 
             #
             # - this pod can be switched to draining mode when being signaled
             # - the configuration file will be re-written using an alternate template
-            # - the pod must then be restarted for the change to take effect
+            # - the proxy is then reloaded for the change to take effect
             # - the input YAML payload should be a comma separated list of urls, for instance :
             #
             # urls:
@@ -97,15 +473,24 @@ if __name__ == '__main__':
             #
             urls = js['urls'].split(',')
             logger.info('rendering draining.cfg (%s)' % js['urls'])
-            env = Environment(loader=FileSystemLoader(join(dirname(__file__), 'templates')))
             mappings = \
                 {
                     'default': self.hints['namespace'],
                     'listeners': {'listener-%d' % index: endpoint for index, endpoint in enumerate(urls)}
                 }
 
-            template = env.get_template('draining.cfg')
-            with open('%s/frontend.cfg' % self.cwd, 'w') as f:
-                f.write(template.render(mappings))
+            running = self._running()
+
+            if _write('%s/frontend.cfg' % self.cwd, _render('draining.cfg', mappings)) and running:
+
+                self._reload(running)
+
+    #
+    # - serve the reload latencies over HTTP on metrics_port, 0 to disable
+    #
+    metrics_port = int(cfg['metrics_port']) if 'metrics_port' in cfg else 9100
+
+    if metrics_port:
+        REGISTRY.serve(metrics_port)
 
     Pod().boot(Strategy, model=Model)
\ No newline at end of file
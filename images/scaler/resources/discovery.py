@@ -0,0 +1,362 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+
+from fnmatch import fnmatch
+from itertools import count
+from pykka import ThreadingActor
+from metrics import REGISTRY
+from scheduler import Rest
+from tracing import TRACER
+
+logger = logging.getLogger('ochopod')
+
+_ticks = REGISTRY.histogram('actor_tick_seconds', 'Time spent by the actors on each tick.', ['actor'])
+_tracked = REGISTRY.gauge('clusters_tracked', 'Number of clusters currently looked after, by loop.', ['loop'])
+_workers = REGISTRY.gauge('workers', 'Number of worker actors currently running, by loop.', ['loop'])
+
+def expand(remote, globs):
+    """
+        Expands glob patterns into one '<namespace>.<cluster>*' glob per distinct cluster currently found. None is
+        returned if the portal could not be reached, which is not the same as finding nothing.
+
+        :param remote: function used to pass toolset commands to the portal
+        :param globs: list of glob patterns
+    """
+
+    if not globs:
+
+        return set()
+
+    js = remote('grep %s -j' % ' '.join(globs))
+
+    if not js['ok']:
+
+        logger.warning('Discovery: communication with portal failed (could not grep %s).' % ' '.join(globs))
+        return None
+
+    return set('%s*' % key.rsplit(' #', 1)[0] for key in json.loads(js['out']))
+
+def _glob(cluster):
+
+    #
+    # - clusters are either a glob pattern or a (glob pattern, haproxy) pair for the scaler
+    #
+    return cluster[0] if isinstance(cluster, tuple) else cluster
+
+class Worker(ThreadingActor):
+    """
+        Base for the actors looking after a changing set of clusters on behalf of a Supervisor. Each cluster gets its
+        own chain of ticks from the scheduler, which is dropped as soon as the cluster is removed. Subclasses implement
+        tick() and, if they keep state per cluster, forget(). Subclasses handling all their clusters in one pass
+        override chain() to have them share a single chain of ticks, dropped once they are all removed.
+
+        Chains whose tick returned a Rest (i.e which are done with their pass) can be woken up right away, e.g when
+        told the pods of one of their clusters changed.
+
+        :param scheduler: the Scheduler waking the actor up
+        :param clusters: list of the clusters to start with
+    """
+
+    def __init__(self, scheduler, clusters):
+
+        super(Worker, self).__init__()
+
+        self.scheduler = scheduler
+        self.clusters = sorted(clusters)
+
+        #
+        # - chain -> the clusters it ticks for
+        # - chain -> the epoch its ticks carry, bumped whenever it is started or woken up so that ticks from before a
+        # - removal (or the one pending when woken up) can be told apart and dropped
+        #
+        self.chains = {}
+        self.epochs = {}
+        self.counter = count()
+        self.resting = set()
+
+    def on_start(self):
+
+        self.add(self.clusters)
+
+    def on_receive(self, msg):
+
+        action = msg.get('action')
+
+        if action == 'add':
+
+            self.add(msg['clusters'])
+
+        elif action == 'remove':
+
+            self.remove(msg['clusters'])
+
+        elif action == 'wake':
+
+            self.wake(msg['clusters'])
+
+        elif action == 'tick' and self.epochs.get(msg['cluster']) == msg['epoch']:
+
+            actor = self.__class__.__name__.lower()
+
+            with _ticks.time(actor=actor), TRACER.tick(actor, msg['cluster']) as traced:
+
+                delay = traced.sleep = self.tick(msg['cluster'])
+
+            if isinstance(delay, Rest):
+
+                self.resting.add(msg['cluster'])
+
+            else:
+
+                self.resting.discard(msg['cluster'])
+
+            self.scheduler.tell(delay, self.actor_ref, msg)
+
+    def add(self, clusters):
+        """
+            Starts looking after clusters, the ones already known being left untouched.
+            :param clusters: list of clusters
+        """
+
+        for cluster in clusters:
+
+            chain = self.chain(cluster)
+
+            if chain not in self.chains:
+
+                self.chains[chain] = set()
+                self.epochs[chain] = next(self.counter)
+                self.actor_ref.tell({'action': 'tick', 'cluster': chain, 'epoch': self.epochs[chain]})
+
+            self.chains[chain].add(cluster)
+
+        self.clusters = sorted(cluster for clusters in self.chains.itervalues() for cluster in clusters)
+
+    def remove(self, clusters):
+        """
+            Stops looking after clusters.
+            :param clusters: list of clusters
+        """
+
+        for cluster in clusters:
+
+            chain = self.chain(cluster)
+
+            if cluster in self.chains.get(chain, ()):
+
+                self.chains[chain].discard(cluster)
+
+                if not self.chains[chain]:
+                    del self.chains[chain]
+                    del self.epochs[chain]
+                    self.resting.discard(chain)
+
+                self.clusters = sorted(cluster for clusters in self.chains.itervalues() for cluster in clusters)
+                self.forget(cluster)
+
+    def wake(self, clusters):
+        """
+            Cuts short the rest of clusters, their next pass starting right away. Clusters in the middle of a pass are
+            left alone.
+            :param clusters: list of clusters
+        """
+
+        for chain in set(self.chain(cluster) for cluster in clusters):
+
+            if chain in self.resting:
+
+                self.resting.discard(chain)
+                self.epochs[chain] = next(self.counter)
+                self.actor_ref.tell({'action': 'tick', 'cluster': chain, 'epoch': self.epochs[chain]})
+
+    def chain(self, cluster):
+        """
+            Returns the chain of ticks a cluster belongs to, by default its own.
+            :param cluster: the cluster
+        """
+
+        return cluster
+
+    def tick(self, chain):
+        """
+            Does the work due for a chain (by default a cluster) and returns the number of seconds until its next tick.
+            :param chain: the chain, see chain()
+        """
+
+        raise NotImplementedError
+
+    def forget(self, cluster):
+        """
+            Drops whatever state is kept for a cluster that was removed.
+            :param cluster: the cluster
+        """
+
+        pass
+
+class Supervisor(ThreadingActor):
+    """
+        Keeps a bounded pool of worker actors in line with the clusters currently deployed. Every period the clusters
+        are discovered again (typically by expanding the env glob patterns against the portal snapshot): new ones are
+        handed to the least busy worker (spawning one while below the pool size) and the ones gone are removed from
+        theirs, workers left with nothing being stopped. Clusters found again stay where they are, along with their
+        state.
+
+        Given an event source (see events.py), the supervisor also subscribes to it for the names matching its glob
+        patterns: clusters whose pods changed are woken up in their worker and unknown ones trigger a discovery on the
+        spot.
+
+        :param scheduler: the Scheduler waking the actor up
+        :param discover: function returning the collection of clusters currently deployed, None if unknown
+        :param spawn: function starting a worker for a list of clusters and returning its actor ref, workers must
+                      understand {'action': 'add'|'remove', 'clusters': [...]} messages
+        :param period: float number of seconds between discoveries
+        :param workers: int maximum number of workers
+        :param events: optional event source
+        :param globs: glob patterns the clusters are discovered from, only their changes being subscribed to
+        :param name: name of the loop the supervisor runs, used to label its metrics
+    """
+
+    def __init__(self, scheduler, discover, spawn, period=60.0, workers=4, events=None, globs=None, name='supervisor'):
+
+        super(Supervisor, self).__init__()
+
+        self.scheduler = scheduler
+        self.discover = discover
+        self.spawn = spawn
+        self.period = period
+        self.workers = workers
+        self.events = events
+        self.globs = globs
+        self.name = name
+
+        #
+        # - list of [actor ref, set of its clusters]
+        #
+        self.pool = []
+
+    def on_start(self):
+
+        if self.events:
+            self.events.subscribe(self.actor_ref, self.globs)
+
+        self.actor_ref.tell({'action': 'discover'})
+
+    def on_receive(self, msg):
+
+        if 'action' in msg and msg['action'] == 'discover':
+
+            self._discover()
+            self.scheduler.tell(self.period, self.actor_ref, {'action': 'discover'})
+
+        elif 'action' in msg and msg['action'] == 'changed':
+
+            #
+            # - '<namespace>.<cluster>' names whose pods changed
+            # - look for new clusters right away if some are not matched by any of ours (those just found start with
+            # - a pass anyway, only wake the others)
+            #
+            names = msg['names']
+            assigned = set(cluster for _, clusters in self.pool for cluster in clusters)
+
+            if any(not any(fnmatch(name, _glob(cluster)) for cluster in assigned) for name in names):
+                self._discover()
+
+            for ref, clusters in self.pool:
+
+                woken = [cluster for cluster in clusters & assigned if any(fnmatch(name, _glob(cluster)) for name in names)]
+
+                if woken:
+                    ref.tell({'action': 'wake', 'clusters': woken})
+
+    def on_stop(self):
+
+        for ref, _ in self.pool:
+
+            try:
+
+                ref.stop()
+
+            except Exception:
+
+                pass
+
+    def _discover(self):
+
+        try:
+
+            found = self.discover()
+
+            if found is not None:
+                self._balance(set(found))
+
+        except Exception as e:
+
+            logger.warning('Supervisor actor exception: %s' % e)
+
+    def _balance(self, found):
+
+        #
+        # - forget about workers that died, their clusters will be handed out again below
+        #
+        self.pool = [entry for entry in self.pool if entry[0].is_alive()]
+
+        assigned = set(cluster for _, clusters in self.pool for cluster in clusters)
+
+        for entry in self.pool:
+
+            ref, clusters = entry
+            gone = clusters - found
+
+            if gone:
+
+                logger.info('Supervisor: %s gone' % ', '.join(map(str, sorted(gone))))
+                clusters -= gone
+                ref.tell({'action': 'remove', 'clusters': sorted(gone)})
+
+        for ref, clusters in [entry for entry in self.pool if not entry[1]]:
+
+            ref.stop(block=False)
+
+        self.pool = [entry for entry in self.pool if entry[1]]
+
+        #
+        # - pool index -> clusters to add to that worker
+        #
+        added = {}
+
+        for cluster in sorted(found - assigned):
+
+            logger.info('Supervisor: %s found' % (cluster,))
+
+            if len(self.pool) < self.workers:
+
+                self.pool.append([self.spawn([cluster]), set([cluster])])
+
+            else:
+
+                index = min(range(len(self.pool)), key=lambda index: len(self.pool[index][1]))
+                self.pool[index][1].add(cluster)
+                added.setdefault(index, []).append(cluster)
+
+        for index, clusters in added.iteritems():
+
+            self.pool[index][0].tell({'action': 'add', 'clusters': clusters})
+
+        _tracked.set(len(found), loop=self.name)
+        _workers.set(len(self.pool), loop=self.name)
@@ -0,0 +1,86 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from collections import deque
+
+class Holt(object):
+    """
+        Holt's linear trend forecaster (double exponential smoothing) fed with one load sample per scaling period. The
+        samples are kept in a bounded ring buffer, which is used to convert the forecast horizon from seconds to periods.
+        The error of each one-step-ahead forecast is tracked as an exponentially weighted average, relative to the load.
+
+        :param alpha: float smoothing factor for the level, in ]0, 1]
+        :param beta: float smoothing factor for the trend, in ]0, 1]
+        :param history: int number of samples kept
+    """
+
+    def __init__(self, alpha=0.5, beta=0.3, history=120):
+
+        assert 0 < alpha <= 1 and 0 < beta <= 1, 'alpha & beta must be in ]0, 1]'
+
+        self.alpha = alpha
+        self.beta = beta
+        self.samples = deque(maxlen=history)
+        self.level = None
+        self.trend = 0.0
+        self.predicted = None
+        self.error = None
+
+    def add(self, value, now):
+        """
+            Adds a load sample.
+            :param value: float load
+            :param now: timestamp of the sample
+        """
+
+        if self.predicted is not None:
+
+            #
+            # - relative error of what we forecast for this sample (loads below 1 count as 1 to avoid blowing up)
+            #
+            error = abs(value - self.predicted) / max(abs(value), 1.0)
+            self.error = error if self.error is None else 0.8 * self.error + 0.2 * error
+
+        if self.level is None:
+
+            self.level = float(value)
+
+        else:
+
+            last = self.level
+            self.level = self.alpha * value + (1 - self.alpha) * (self.level + self.trend)
+            self.trend = self.beta * (self.level - last) + (1 - self.beta) * self.trend
+
+        self.samples.append((now, value))
+        self.predicted = self.level + self.trend
+
+    def forecast(self, horizon):
+        """
+            Returns the load forecast horizon seconds after the last sample (never negative).
+            :param horizon: float number of seconds to look ahead
+        """
+
+        if self.level is None:
+
+            return 0.0
+
+        if len(self.samples) < 2:
+
+            return self.level
+
+        interval = float(self.samples[-1][0] - self.samples[0][0]) / (len(self.samples) - 1)
+        steps = horizon / interval if interval > 0 else 0
+        return max(0.0, self.level + steps * self.trend)
@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+import time
+
+from os.path import basename, expanduser, isfile
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+from metrics import REGISTRY
+
+logger = logging.getLogger('ochopod')
+
+_latency = REGISTRY.histogram('portal_request_seconds', 'Latency of the portal requests by toolset command.', ['command'])
+_failures = REGISTRY.counter('portal_request_failures_total', 'Failed portal requests by toolset command.', ['command'])
+
+#
+# - toolset commands that only read state and can therefore be sent again when the connection breaks
+#
+READS = ('grep', 'poll', 'port')
+
+class Portal(object):
+    """
+        Client for the ochothon portal. Toolset command lines are POSTed to /shell over a small pool of keep-alive
+        connections instead of forking a shell and curl for each call. Instances are callable and return the same
+        {'ok', 'out'} dict the portal sends back, which means they can be handed to the actors as their remote.
+
+        The portal is shared by all the actors in the daemon: the connection pool is thread-safe and the request
+        latencies go to the metrics registry.
+
+        :param portal: connection string for the portal (<ip>:<port>), as found in the .portal file
+        :param timeout: float number of seconds allowed for each HTTP request
+        :param retries: int number of times a read-only request (see READS) is re-attempted when the connection fails
+        :param pool: int number of keep-alive connections held to the portal
+    """
+
+    def __init__(self, portal, timeout=20.0, retries=2, pool=4):
+
+        self.portal = portal
+        self.url = '%s/shell' % (portal if portal.startswith('http') else 'http://%s' % portal)
+        self.timeout = timeout
+        self.retries = retries
+
+        #
+        # - mount a pooled adapter on the session
+        # - retries are handled below (the adapter would not re-attempt POST requests anyway)
+        #
+        self.session = Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool))
+
+    def __call__(self, cmdline):
+
+        #
+        # - this block mirrors cli.py in ochothon
+        # - any token pointing to a local file is uploaded and replaced by its basename
+        # - in debug mode the verbatim response from the portal is dumped on stdout
+        #
+        now = time.time()
+        tokens = cmdline.split(' ')
+        paths = [expanduser(token) for token in tokens if isfile(expanduser(token))]
+        line = ' '.join([basename(token) if isfile(expanduser(token)) else token for token in tokens])
+        logger.debug('"%s" -> %s' % (line, self.portal))
+
+        ok = False
+        try:
+
+            reply = self._post(line, paths, self.retries if tokens[0] in READS else 0)
+            assert reply.status_code == 200, 'i/o failure (is the proxy portal down ?)'
+            js = json.loads(reply.text)
+            ok = js['ok']
+
+        finally:
+
+            elapsed = time.time() - now
+            _latency.observe(elapsed, command=tokens[0])
+
+            if not ok:
+                _failures.inc(command=tokens[0])
+
+        logger.debug('<- %s (took %.2f seconds) ->\n\t%s' % (self.portal, elapsed, '\n\t'.join(js['out'].split('\n'))))
+        return js
+
+    def _post(self, line, paths, retries):
+
+        for attempt in range(retries + 1):
+
+            files = {basename(path): open(path, 'rb') for path in paths}
+
+            try:
+
+                return self.session.post(self.url, headers={'X-Shell': line}, files=files or None, timeout=self.timeout)
+
+            except ConnectionError as failure:
+
+                #
+                # - the connection was refused, a pooled socket went stale or the connection broke after the command
+                #   was sent, in which case the portal may well have run it
+                # - only read-only commands are therefore sent again, a scale or kill is never run twice
+                #
+                assert attempt < retries, 'i/o failure (is the proxy portal down ?)'
+                logger.debug('portal @ %s unreachable (%s), retrying' % (self.portal, failure))
+
+            finally:
+
+                for f in files.values():
+                    f.close()
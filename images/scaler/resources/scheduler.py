@@ -0,0 +1,134 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import heapq
+import logging
+import time
+
+from itertools import count
+from threading import Condition, Thread
+from pykka.exceptions import ActorDeadError
+
+logger = logging.getLogger('ochopod')
+
+class Scheduler(object):
+    """
+        Timer shared by all the actors of a daemon. Instead of sleeping in on_receive() an actor asks the scheduler to
+        tell it a message once some delay has elapsed, and goes back to waiting on its inbox (which means a stop() takes
+        effect right away). A single thread keeps the pending messages in a heap ordered by due time.
+    """
+
+    def __init__(self):
+
+        self.cond = Condition()
+        self.heap = []
+        self.seq = count()
+        self.running = True
+
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def tell(self, delay, ref, message):
+        """
+            Tells a message to an actor once delay seconds have elapsed.
+
+            :param delay: float number of seconds to wait, 0 or less to deliver right away
+            :param ref: the pykka actor ref to tell
+            :param message: the message to tell
+        """
+
+        with self.cond:
+
+            heapq.heappush(self.heap, (time.time() + max(0, delay), next(self.seq), ref, message))
+            self.cond.notify()
+
+    def stop(self):
+        """
+            Stops the scheduler, dropping any pending message.
+        """
+
+        with self.cond:
+
+            self.running = False
+            self.heap = []
+            self.cond.notify()
+
+    def _run(self):
+
+        while True:
+
+            with self.cond:
+
+                while self.running and (not self.heap or self.heap[0][0] > time.time()):
+                    self.cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+
+                if not self.running:
+                    return
+
+                _, _, ref, message = heapq.heappop(self.heap)
+
+            try:
+
+                ref.tell(message)
+
+            except ActorDeadError:
+
+                #
+                # - the actor was stopped meanwhile
+                #
+                pass
+
+class Rest(float):
+    """
+        Pause a task yields at the end of a pass, as opposed to one between two of its steps. Rests are the pauses an
+        event may cut short (see discovery.py).
+    """
+
+    pass
+
+def advance(task, factory, idle):
+    """
+        Runs a periodic task up to its next pause. Tasks are generators yielding the number of seconds to wait before
+        being resumed, where they would otherwise have slept. A new pass is started with factory() once the current one
+        is over.
+
+        Returns the task (to pass back next time) and the number of seconds to wait before calling advance() again.
+
+        :param task: the current pass, None to start a new one
+        :param factory: function returning a new pass
+        :param idle: float number of seconds to wait if a new pass ends without pausing
+    """
+
+    if task is not None:
+
+        try:
+
+            return task, next(task)
+
+        except StopIteration:
+
+            pass
+
+    task = factory()
+
+    try:
+
+        return task, next(task)
+
+    except StopIteration:
+
+        return None, idle
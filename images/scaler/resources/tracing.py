@@ -0,0 +1,233 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import cProfile
+import json
+import logging
+import os
+import signal
+import time
+
+from collections import deque
+from itertools import count
+from threading import Lock, local
+
+logger = logging.getLogger('ochopod')
+
+class Tick(object):
+    """
+        Timings of one tick, i.e of one actor running one of its passes up to its next pause. The tick is split into
+        phases by calling phase() (see below) as it goes, each phase lasting until the next one starts. Phases entered
+        several times (e.g one fetch per check) add up.
+
+        :param tracer: the Tracer the tick is recorded into
+        :param actor: name of the actor, e.g 'watcher'
+        :param subject: what the tick is about, e.g the cluster
+    """
+
+    def __init__(self, tracer, actor, subject):
+
+        self.tracer = tracer
+        self.actor = actor
+        self.subject = subject
+        self.phases = {}
+        self.current = None
+        self.sleep = None
+        self.profile = None
+
+    def __enter__(self):
+
+        self.previous = getattr(_current, 'tick', None)
+        _current.tick = self
+        self.profile = self.tracer._profile(self.actor)
+        self.started = self.mark = time.time()
+
+        if self.profile:
+            self.profile.enable()
+
+        return self
+
+    def __exit__(self, *_):
+
+        now = time.time()
+
+        if self.profile:
+            self.profile.disable()
+
+        self.enter(None, now)
+        _current.tick = self.previous
+        self.tracer._record(self, now - self.started)
+
+    def enter(self, phase, now=None):
+
+        #
+        # - close the phase in progress, time until the first phase is accounted as 'other'
+        #
+        now = now or time.time()
+        closed = self.current or 'other'
+        self.phases[closed] = self.phases.get(closed, 0.0) + now - self.mark
+        self.current = phase
+        self.mark = now
+
+class Tracer(object):
+    """
+        Bounded in-memory buffer of the last ticks run by the actors of the daemon, along with the time spent in each
+        of their phases (fetch, parse, analyse, decide, act...) and the pause they asked for (sleep). Oldest ticks are
+        dropped first.
+
+        Optionally every Nth tick of each actor is run under cProfile, its stats being written to disk (look at them
+        with pstats or any cProfile viewer).
+
+        :param size: int number of ticks kept
+        :param every: int profile one tick out of every that many per actor, 0 to never profile
+        :param directory: where the cProfile stats are written
+    """
+
+    def __init__(self, size=256, every=0, directory='/tmp'):
+
+        self.lock = Lock()
+        self.seq = count()
+        self.configure(size, every, directory)
+
+    def configure(self, size=256, every=0, directory='/tmp'):
+
+        assert size > 0, 'the trace buffer must hold at least 1 tick'
+
+        with self.lock:
+
+            self.ticks = deque(maxlen=size)
+            self.every = every
+            self.directory = directory
+            self.counts = {}
+
+    def tick(self, actor, subject=None):
+        """
+            Returns a context manager tracing the tick it wraps, e.g::
+
+                with TRACER.tick('watcher', cluster) as tick:
+                    tick.sleep = self.tick(cluster)
+
+            :param actor: name of the actor
+            :param subject: what the tick is about, e.g the cluster
+        """
+
+        return Tick(self, actor, subject)
+
+    def dump(self):
+        """
+            Returns the ticks currently buffered, oldest first.
+        """
+
+        with self.lock:
+
+            return list(self.ticks)
+
+    def write(self, path):
+        """
+            Writes the ticks currently buffered to disk as JSON.
+            :param path: file to write
+        """
+
+        with open(path, 'w') as f:
+
+            json.dump(self.dump(), f, indent=2)
+
+        logger.info('Tracer: %d ticks written to %s' % (len(self.ticks), path))
+
+    def _profile(self, actor):
+
+        if not self.every:
+            return None
+
+        with self.lock:
+
+            n = self.counts[actor] = self.counts.get(actor, 0) + 1
+
+        return cProfile.Profile() if n % self.every == 0 else None
+
+    def _record(self, tick, seconds):
+
+        record = \
+            {
+                'seq': next(self.seq),
+                'actor': tick.actor,
+                'subject': str(tick.subject),
+                'started': tick.started,
+                'seconds': seconds,
+                'phases': tick.phases,
+                'sleep': tick.sleep
+            }
+
+        if tick.profile:
+
+            path = os.path.join(self.directory, '%s-%d.prof' % (tick.actor, record['seq']))
+
+            try:
+
+                tick.profile.dump_stats(path)
+                record['profile'] = path
+
+            except (IOError, OSError) as e:
+
+                logger.warning('Tracer: could not write %s (%s)' % (path, e))
+
+        with self.lock:
+
+            self.ticks.append(record)
+
+#
+# - the tick in progress on each actor thread
+#
+_current = local()
+
+def phase(name):
+    """
+        Marks the start of a phase of the tick in progress on this thread (if any), the previous phase ending there.
+        Meant to be sprinkled over the actors' passes, e.g phase('fetch') right before a grep.
+
+        :param name: phase name, e.g 'fetch', 'parse', 'analyse', 'decide' or 'act'
+    """
+
+    tick = getattr(_current, 'tick', None)
+
+    if tick:
+        tick.enter(name)
+
+def install(path, signum=signal.SIGUSR1):
+    """
+        Writes the ticks buffered to disk whenever the daemon receives a signal, e.g kill -USR1 <pid>. Must be called
+        from the main thread.
+
+        :param path: file to write
+        :param signum: signal to handle
+    """
+
+    def _handler(*_):
+
+        try:
+
+            TRACER.write(path)
+
+        except Exception as e:
+
+            logger.warning('Tracer: could not write %s (%s)' % (path, e))
+
+    signal.signal(signum, _handler)
+
+#
+# - the tracer shared by all the actors of the daemon
+#
+TRACER = Tracer()
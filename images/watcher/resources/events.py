@@ -0,0 +1,192 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+
+from fnmatch import fnmatch
+from functools import partial
+from threading import RLock
+from pykka.exceptions import ActorDeadError
+
+logger = logging.getLogger('ochopod')
+
+class Events(object):
+    """
+        Base class for the sources pushing pod changes to the supervisors (see discovery.py) as they happen, instead of
+        the actors waiting for their next poll to notice. Subscribers are told {'action': 'changed', 'names': [...]}
+        listing the '<namespace>.<cluster>' names whose pods came, went or changed state, filtered against the glob
+        patterns they subscribed with. Changes no subscriber is interested in are dropped altogether.
+
+        :param snapshot: optional Snapshot expired on each change so that the greps that follow see it
+    """
+
+    def __init__(self, snapshot=None):
+
+        self.snapshot = snapshot
+        self.subscribers = []
+        self.lock = RLock()
+
+    def subscribe(self, ref, globs=None):
+        """
+            Subscribes an actor to the changes.
+            :param ref: the pykka actor ref to tell
+            :param globs: optional glob patterns the names must match, None for all of them
+        """
+
+        with self.lock:
+
+            self.subscribers.append((ref, globs))
+
+    def changed(self, names):
+        """
+            Tells the subscribers some clusters changed.
+            :param names: collection of '<namespace>.<cluster>' names
+        """
+
+        #
+        # - only expire the snapshot & tell the subscribers about the names they look after, a change elsewhere in the
+        # - deployment (e.g another cluster scaling out) costing nothing
+        #
+        with self.lock:
+
+            told = [(subscriber, sorted(name for name in names if subscriber[1] is None or any(fnmatch(name, glob) for glob in subscriber[1])))
+                    for subscriber in self.subscribers]
+
+            told = [(subscriber, matching) for subscriber, matching in told if matching]
+
+            if told and self.snapshot:
+                self.snapshot.expire()
+
+            for subscriber, matching in told:
+
+                try:
+
+                    subscriber[0].tell({'action': 'changed', 'names': matching})
+
+                except ActorDeadError:
+
+                    self.subscribers.remove(subscriber)
+
+    def start(self):
+
+        pass
+
+    def stop(self):
+
+        pass
+
+class ZooKeeper(Events):
+    """
+        Watches the ochopod registrations in ZooKeeper: each pod holds an ephemeral znode under
+        <root>/<namespace>.<cluster>/pods whose payload is updated as its sub-process changes state. A children watch
+        per cluster catches pods coming & going and a data watch per pod catches its state changes. Only the cluster
+        names are passed on, the actors then grep the portal as usual (ZooKeeper just tells them when).
+
+        Kazoo is only needed when this source is used (it ships with ochopod anyway).
+
+        :param hosts: ZooKeeper connection string, e.g the OCHOPOD_ZK hint
+        :param root: znode under which the clusters register
+        :param snapshot: optional Snapshot expired on each change
+    """
+
+    def __init__(self, hosts, root='/ochopod/clusters', snapshot=None):
+
+        super(ZooKeeper, self).__init__(snapshot)
+
+        self.hosts = hosts
+        self.root = root
+        self.client = None
+
+        #
+        # - cluster name -> set of its pod znodes being watched
+        # - (cluster name, pod znode) pairs whose data watch has yet to fire for the first time
+        #
+        self.watched = {}
+        self.priming = set()
+
+    def start(self):
+
+        from kazoo.client import KazooClient
+
+        self.client = KazooClient(hosts=self.hosts, read_only=True)
+        self.client.start()
+        self.client.ChildrenWatch(self.root, self._clusters)
+        logger.info('Events: watching %s @ %s' % (self.root, self.hosts))
+
+    def stop(self):
+
+        if self.client:
+
+            self.client.stop()
+            self.client.close()
+
+    def _clusters(self, names):
+
+        #
+        # - called by kazoo whenever clusters register or go away
+        #
+        with self.lock:
+
+            added = set(names) - set(self.watched)
+            gone = set(self.watched) - set(names)
+
+            for name in gone:
+                del self.watched[name]
+
+            for name in added:
+                self.watched[name] = set()
+                self.client.ChildrenWatch('%s/%s/pods' % (self.root, name), partial(self._pods, name))
+
+        if added or gone:
+            self.changed(added | gone)
+
+    def _pods(self, name, pods):
+
+        #
+        # - called by kazoo whenever pods of the cluster register or go away
+        # - returning False drops the watch once the cluster is gone
+        #
+        with self.lock:
+
+            if name not in self.watched:
+                return False
+
+            added = set(pods) - self.watched[name]
+            self.watched[name] = set(pods)
+
+            for pod in added:
+                self.priming.add((name, pod))
+                self.client.DataWatch('%s/%s/pods/%s' % (self.root, name, pod), partial(self._pod, name, pod))
+
+        self.changed([name])
+
+    def _pod(self, name, pod, data, stat, event=None):
+
+        #
+        # - called by kazoo whenever the pod's payload changes (data is None once its znode is gone)
+        # - the first call just reports the payload as of when the watch was set, which _pods() already covered
+        #
+        with self.lock:
+
+            if data is None or pod not in self.watched.get(name, ()):
+                self.priming.discard((name, pod))
+                return False
+
+            if (name, pod) in self.priming:
+                self.priming.discard((name, pod))
+                return
+
+        self.changed([name])
@@ -40,7 +40,16 @@ if __name__ == '__main__':
 
         def initialize(self):
 
-            splunk = cfg['splunk']
+            #
+            # - the Splunk forwarder is optional: only set it up if it was installed (see the Dockerfile) and we have
+            # - indexers to forward to, the alerts otherwise go to the sinks listed in ALERTS_SINKS (see watcher.py)
+            #
+            splunk = cfg.get('splunk', {})
+
+            if not splunk.get('forward') or not os.path.exists('/opt/splunkforwarder'):
+
+                logger.info('Splunk forwarder not enabled')
+                return
 
             env = Environment(loader=FileSystemLoader('/opt/watcher/templates'))
             template = env.get_template('props.conf')